@@ -1,23 +1,48 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import text
 from src.database.models import Base
-from os import getenv
+from src.database.engine import engine
 import asyncio
 import logging
 
 
-# Создаём асинхронный движок
-engine = create_async_engine(getenv("PG_URL"), echo=True)
-
-# Создаём асинхронную сессию
-async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# create_all не меняет существующие таблицы: новые колонки и индексы для уже
+# развернутой базы добавляются здесь. Каждое выражение идемпотентно, поэтому
+# скрипт можно запускать при каждом старте.
+MIGRATIONS = [
+    # users: время последней активности и индексы для статистики
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_users_last_seen_at ON users (last_seen_at)",
+    "CREATE INDEX IF NOT EXISTS ix_users_created_at ON users (created_at)",
+    # movies: локальный каталог фильмов Кинопоиска
+    "ALTER TABLE movies ADD COLUMN IF NOT EXISTS kinopoisk_id INTEGER UNIQUE",
+    "ALTER TABLE movies ADD COLUMN IF NOT EXISTS year INTEGER",
+    "ALTER TABLE movies ADD COLUMN IF NOT EXISTS rating DOUBLE PRECISION",
+    "ALTER TABLE movies ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT now()",
+    "ALTER TABLE movies ADD COLUMN IF NOT EXISTS poster_file_id VARCHAR(255)",
+    "CREATE INDEX IF NOT EXISTS ix_movies_title_trgm ON movies USING gin (title gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_movies_title_tsv ON movies USING gin (to_tsvector('russian'::regconfig, title))",
+    # recommendations: оценка и чтение рекомендаций пользователя по индексу
+    "ALTER TABLE recommendations ADD COLUMN IF NOT EXISTS score DOUBLE PRECISION NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS ix_recommendations_user_score ON recommendations (user_id, score)",
+    # favorites и search_history
+    "CREATE INDEX IF NOT EXISTS ix_favorites_user_added ON favorites (user_id, added_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_search_history_searched_at ON search_history (searched_at)",
+    # mailing_jobs: аренда задания одним процессом
+    "ALTER TABLE mailing_jobs ADD COLUMN IF NOT EXISTS owner VARCHAR(64)",
+    "ALTER TABLE mailing_jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP",
+]
+
 async def create_tables():
     try:
         async with engine.begin() as conn:
+            # Нужно для триграммного индекса по названиям фильмов
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
             await conn.run_sync(Base.metadata.create_all)
+            for statement in MIGRATIONS:
+                await conn.execute(text(statement))
         logger.info("Таблицы созданы!")
     except Exception as e:
         logger.error(f"Ошибка при создании таблиц: {e}")
@@ -1,12 +1,33 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import create_engine
-from os import getenv
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import func, or_, literal_column, bindparam, String, update, delete, literal, text, values, column, BigInteger, tuple_, case
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from os import getenv
 import logging
 
-# Инициализация асинхронного движка
-engine = create_async_engine(getenv("PG_URL"), echo=True)
+from src.utils.cache import TTLCache
+
+# Кэш профилей пользователей по telegram_id (None - пользователь не зарегистрирован)
+profile_cache = TTLCache(
+    maxsize=int(getenv("PROFILE_CACHE_SIZE", "10000")),
+    ttl=float(getenv("PROFILE_CACHE_TTL", "300"))
+)
+_MISSING = object()
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
 class CRUDBase:
     def __init__(self, model):
@@ -51,6 +72,62 @@ class CRUDBase:
             await db.rollback()
             raise
 
+    async def update_returning(self, db: AsyncSession, filters: Dict[str, Any], **kwargs):
+        """
+        Обновляет записи по фильтру одним UPDATE ... RETURNING и возвращает первую из них.
+        """
+        stmt = (
+            update(self.model)
+            .filter_by(**filters)
+            .values(**kwargs)
+            .returning(self.model)
+            .execution_options(synchronize_session=False)
+        )
+        result = await db.execute(stmt)
+        db_obj = result.scalars().first()
+        await db.commit()
+        return db_obj
+
+    async def upsert(self, db: AsyncSession, index_elements: List[str], update_fields: List[str] = None, **kwargs):
+        """
+        INSERT ... ON CONFLICT (index_elements) DO UPDATE ... RETURNING одним запросом.
+        По умолчанию при конфликте обновляются все переданные поля, кроме ключевых.
+        """
+        stmt = insert(self.model).values(**kwargs)
+        if update_fields is None:
+            update_fields = [key for key in kwargs if key not in index_elements]
+        if update_fields:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={key: stmt.excluded[key] for key in update_fields}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        result = await db.execute(stmt.returning(self.model))
+        db_obj = result.scalars().first()
+        await db.commit()
+        return db_obj
+
+    async def bulk_create(self, db: AsyncSession, rows: List[Dict[str, Any]]) -> int:
+        """
+        Вставляет много записей одним пакетным INSERT.
+        """
+        if not rows:
+            return 0
+        await db.execute(insert(self.model), rows)
+        await db.commit()
+        return len(rows)
+
+    async def bulk_update(self, db: AsyncSession, rows: List[Dict[str, Any]]) -> int:
+        """
+        Пакетно обновляет записи по первичному ключу (каждый словарь должен содержать id).
+        """
+        if not rows:
+            return 0
+        await db.execute(update(self.model), rows)
+        await db.commit()
+        return len(rows)
+
     async def delete(self, db: AsyncSession, id: int):
         """
         Удаляет запись.
@@ -61,7 +138,9 @@ class CRUDBase:
             await db.commit()
         return db_obj
 
-from src.database.models import User, Movie, Genre, Favorite, Recommendation, SearchHistory
+from src.database.models import (
+    User, Movie, Genre, Favorite, Recommendation, SearchHistory, MailingJob, MailingRecipient, movie_genre_association
+)
 
 class CRUDUser(CRUDBase):
     def __init__(self):
@@ -74,6 +153,65 @@ class CRUDUser(CRUDBase):
         result = await db.execute(select(self.model).filter(self.model.telegram_id == telegram_id))
         return result.scalars().first()
     
+    async def get_profile(self, db: AsyncSession, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает профиль пользователя (имя, возраст, пол, активность) одним запросом
+        с кэшированием по telegram_id. None, если пользователь не зарегистрирован.
+        """
+        profile = profile_cache.get(telegram_id, _MISSING)
+        if profile is not _MISSING:
+            return profile
+        result = await db.execute(
+            select(User.id, User.telegram_id, User.first_name, User.age, User.sex, User.is_active)
+            .where(User.telegram_id == telegram_id)
+        )
+        row = result.mappings().first()
+        profile = dict(row) if row else None
+        profile_cache.set(telegram_id, profile)
+        return profile
+
+    @staticmethod
+    def _cache_profile(user: User):
+        profile_cache.set(user.telegram_id, {
+            'id': user.id,
+            'telegram_id': user.telegram_id,
+            'first_name': user.first_name,
+            'age': user.age,
+            'sex': user.sex,
+            'is_active': user.is_active,
+        })
+
+    async def create(self, db: AsyncSession, **kwargs):
+        db_obj = await super().create(db, **kwargs)
+        self._cache_profile(db_obj)
+        return db_obj
+
+    async def update(self, db: AsyncSession, telegram_id: int, **kwargs):
+        try:
+            db_obj = await super().update(db, telegram_id, **kwargs)
+        except Exception:
+            profile_cache.pop(telegram_id)
+            raise
+        if db_obj:
+            self._cache_profile(db_obj)
+        else:
+            profile_cache.pop(telegram_id)
+        return db_obj
+
+    async def update_returning(self, db: AsyncSession, filters: Dict[str, Any], **kwargs):
+        db_obj = await super().update_returning(db, filters, **kwargs)
+        if db_obj:
+            self._cache_profile(db_obj)
+        elif 'telegram_id' in filters:
+            profile_cache.pop(filters['telegram_id'])
+        return db_obj
+
+    async def upsert(self, db: AsyncSession, index_elements: List[str], update_fields: List[str] = None, **kwargs):
+        db_obj = await super().upsert(db, index_elements, update_fields, **kwargs)
+        if db_obj:
+            self._cache_profile(db_obj)
+        return db_obj
+
     async def get_username_by_telegram_id(self, db: AsyncSession, telegram_id: int):
         """
         Возвращает имя пользователя по его Telegram ID.
@@ -98,11 +236,54 @@ class CRUDUser(CRUDBase):
         user = result.scalar_one_or_none()
         return user.sex if user else None
     
+    async def get_stats(self, db: AsyncSession) -> Dict[str, int]:
+        """
+        Сводная статистика по пользователям одним запросом (агрегаты считает БД).
+        """
+        today = func.date_trunc('day', func.now())
+        month_ago = func.now() - text("interval '30 days'")
+        searches_today = (
+            select(func.count())
+            .select_from(SearchHistory)
+            .where(SearchHistory.searched_at >= today)
+            .scalar_subquery()
+        )
+        result = await db.execute(
+            select(
+                func.count().label('total'),
+                func.count().filter(User.is_active.is_(False)).label('blocked'),
+                func.count().filter(User.created_at >= today).label('new_today'),
+                func.count().filter(User.last_seen_at >= month_ago).label('active_month'),
+                searches_today.label('searches_today'),
+            )
+            .select_from(User)
+        )
+        return dict(result.mappings().one())
+
+    async def touch_many(self, db: AsyncSession, telegram_ids: List[int], commit: bool = True):
+        """
+        Отмечает время последней активности для пачки пользователей одним UPDATE.
+        Пользователь, написавший боту, снова активен и получает рассылки
+        (даже если раньше заблокировал бота).
+        """
+        if not telegram_ids:
+            return
+        await db.execute(
+            update(User).where(User.telegram_id.in_(sorted(telegram_ids)))
+            .values(last_seen_at=func.now(), is_active=True)
+        )
+        if commit:
+            await db.commit()
+        for telegram_id in telegram_ids:
+            profile = profile_cache.get(telegram_id)
+            if profile and not profile['is_active']:
+                profile_cache.pop(telegram_id)
+
     async def get_all_user_ids(self, db: AsyncSession):
         """
-        Возвращает только telegram_id всех пользователей (оптимизировано для рассылки)
+        Возвращает только telegram_id активных пользователей (оптимизировано для рассылки)
         """
-        result = await db.execute(select(self.model.telegram_id))
+        result = await db.execute(select(self.model.telegram_id).filter(self.model.is_active.is_(True)))
         return result.scalars().all()
     
 
@@ -117,6 +298,140 @@ class CRUDMovie(CRUDBase):
         result = await db.execute(select(self.model).filter(self.model.tmdb_id == tmdb_id))
         return result.scalars().first()
 
+    async def get_by_kinopoisk_id(self, db: AsyncSession, kinopoisk_id: int, max_age: Optional[timedelta] = None):
+        """
+        Возвращает фильм по ID Кинопоиска вместе с жанрами.
+        Если задан max_age, устаревшая запись считается отсутствующей.
+        """
+        query = (
+            select(self.model)
+            .options(selectinload(self.model.genres))
+            .filter(self.model.kinopoisk_id == kinopoisk_id)
+        )
+        if max_age is not None:
+            query = query.filter(self.model.updated_at >= datetime.now() - max_age)
+        result = await db.execute(query)
+        return result.scalars().first()
+
+    async def search_title(self, db: AsyncSession, query: str, limit: int = 5):
+        """
+        Нечеткий поиск по названию в локальном каталоге (pg_trgm + полнотекстовый).
+        Возвращает список пар (фильм, score) по убыванию score от 0 до 1.
+        """
+        q = bindparam('q', query, type_=String)
+        russian = literal_column("'russian'::regconfig")
+        tsvector = func.to_tsvector(russian, Movie.title)
+        tsquery = func.plainto_tsquery(russian, q)
+        score = func.greatest(func.similarity(Movie.title, q), func.word_similarity(q, Movie.title)).label('score')
+        stmt = (
+            select(Movie, score)
+            .options(selectinload(Movie.genres))
+            .where(or_(
+                Movie.title.op('%')(q),
+                q.op('<%')(Movie.title),
+                tsvector.op('@@')(tsquery),
+            ))
+            .order_by(score.desc(), func.ts_rank(tsvector, tsquery).desc())
+            .limit(limit)
+        )
+        result = await db.execute(stmt)
+        return result.all()
+
+    async def upsert_films(self, db: AsyncSession, films: List[Dict[str, Any]]) -> Dict[int, int]:
+        """
+        Сохраняет нормализованные фильмы (см. normalize_film_data) и их жанры
+        пакетными INSERT ... ON CONFLICT. Возвращает словарь kinopoisk_id -> id.
+        """
+        rows = {}
+        for film in films:
+            kinopoisk_id = _to_int(film.get('id'))
+            if kinopoisk_id is None:
+                continue
+            rows[kinopoisk_id] = {
+                'kinopoisk_id': kinopoisk_id,
+                'title': (film.get('name') or 'Без названия')[:255],
+                'year': _to_int(film.get('year')),
+                'rating': _to_float(film.get('rating')),
+                'poster_url': (film.get('poster') or '')[:255] or None,
+            }
+        if not rows:
+            return {}
+
+        # Сортировка по ключу убирает взаимные блокировки между параллельными upsert
+        values = [rows[key] for key in sorted(rows)]
+        stmt = insert(Movie).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Movie.kinopoisk_id],
+            set_={
+                'title': stmt.excluded.title,
+                'year': stmt.excluded.year,
+                'rating': stmt.excluded.rating,
+                'poster_url': func.coalesce(stmt.excluded.poster_url, Movie.poster_url),
+                # Постер сменился - загруженный в Telegram file_id больше не подходит
+                'poster_file_id': case(
+                    (stmt.excluded.poster_url.is_distinct_from(Movie.poster_url)
+                     & stmt.excluded.poster_url.isnot(None), None),
+                    else_=Movie.poster_file_id
+                ),
+                'updated_at': func.now(),
+            }
+        ).returning(Movie.kinopoisk_id, Movie.id)
+        result = await db.execute(stmt)
+        movie_ids = dict(result.all())
+
+        genre_names = sorted({name for film in films for name in film.get('genres', []) if name})
+        if genre_names:
+            await db.execute(
+                insert(Genre)
+                .values([{'name': name} for name in genre_names])
+                .on_conflict_do_nothing(index_elements=[Genre.name])
+            )
+            result = await db.execute(select(Genre.name, Genre.id).where(Genre.name.in_(genre_names)))
+            genre_ids = dict(result.all())
+
+            links = {
+                (movie_ids[kinopoisk_id], genre_ids[name])
+                for film in films
+                if (kinopoisk_id := _to_int(film.get('id'))) in movie_ids
+                for name in film.get('genres', [])
+                if name in genre_ids
+            }
+            if links:
+                await db.execute(
+                    insert(movie_genre_association)
+                    .values([{'movie_id': m, 'genre_id': g} for m, g in sorted(links)])
+                    .on_conflict_do_nothing()
+                )
+
+        await db.commit()
+        return movie_ids
+
+    async def set_poster_file_id(self, db: AsyncSession, kinopoisk_id: int, file_id: str):
+        """
+        Сохраняет file_id постера, полученный от Telegram.
+        """
+        await db.execute(
+            update(Movie).where(Movie.kinopoisk_id == kinopoisk_id).values(poster_file_id=file_id)
+        )
+        await db.commit()
+
+    @staticmethod
+    def to_film(movie: Movie) -> Dict[str, Any]:
+        """
+        Преобразует запись каталога в формат normalize_film_data.
+        """
+        genre_names = [genre.name for genre in movie.genres]
+        return {
+            'id': str(movie.kinopoisk_id),
+            'name': movie.title,
+            'year': str(movie.year) if movie.year else '',
+            'rating': str(round(movie.rating, 1)) if movie.rating else 'нет',
+            'poster': movie.poster_url or '',
+            'poster_file_id': movie.poster_file_id,
+            'genre': ', '.join(genre_names) if genre_names else 'не указан',
+            'genres': genre_names,
+        }
+
 class CRUDGenre(CRUDBase):
     def __init__(self):
         super().__init__(Genre)
@@ -143,20 +458,91 @@ class CRUDFavorite(CRUDBase):
         """
         Возвращает список избранных фильмов пользователя.
         """
-        result = await db.execute(select(self.model).filter(self.model.user_id == user_id))
+        result = await db.execute(
+            select(self.model).options(selectinload(self.model.movie)).filter(self.model.user_id == user_id)
+        )
         return result.scalars().all()
 
+    async def get_page(self, db: AsyncSession, user_id: int, limit: int = 10, after: tuple = None):
+        """
+        Страница избранного (новые первыми) вместе с фильмами.
+        after - курсор (added_at, id) последней записи предыдущей страницы.
+        Возвращает (записи, курсор следующей страницы или None).
+        """
+        query = (
+            select(self.model)
+            .options(selectinload(self.model.movie))
+            .filter(self.model.user_id == user_id)
+            .order_by(self.model.added_at.desc(), self.model.id.desc())
+            .limit(limit + 1)
+        )
+        if after is not None:
+            query = query.filter(tuple_(self.model.added_at, self.model.id) < tuple_(*after))
+        result = await db.execute(query)
+        items = result.scalars().all()
+        if len(items) > limit:
+            items = items[:limit]
+            return items, (items[-1].added_at, items[-1].id)
+        return items, None
+
+    async def add(self, db: AsyncSession, user_id: int, movie_id: int):
+        """
+        Добавляет фильм в избранное (повторное добавление ничего не делает).
+        """
+        await db.execute(
+            insert(self.model)
+            .values(user_id=user_id, movie_id=movie_id)
+            .on_conflict_do_nothing(constraint='unique_user_movie')
+        )
+        await db.commit()
+
+    async def remove(self, db: AsyncSession, user_id: int, movie_id: int):
+        await db.execute(
+            delete(self.model).where(self.model.user_id == user_id, self.model.movie_id == movie_id)
+        )
+        await db.commit()
+
 class CRUDRecommendation(CRUDBase):
     def __init__(self):
         super().__init__(Recommendation)
 
-    async def get_by_user(self, db: AsyncSession, user_id: int):
+    async def get_by_user(self, db: AsyncSession, user_id: int, limit: int = None):
         """
-        Возвращает список рекомендаций для пользователя.
+        Возвращает список рекомендаций для пользователя (лучшие первыми, вместе с фильмами).
         """
-        result = await db.execute(select(self.model).filter(self.model.user_id == user_id))
+        query = (
+            select(self.model)
+            .options(selectinload(self.model.movie))
+            .filter(self.model.user_id == user_id)
+            .order_by(self.model.score.desc())
+        )
+        if limit:
+            query = query.limit(limit)
+        result = await db.execute(query)
         return result.scalars().all()
 
+    async def get_interactions(self, db: AsyncSession):
+        """
+        Возвращает пары (user_id, movie_id, вес) из избранного и истории поиска.
+        Поиск связывается с фильмом каталога по совпадению названия.
+        """
+        favorites = select(Favorite.user_id, Favorite.movie_id, literal(1.0).label('weight'))
+        searches = (
+            select(SearchHistory.user_id, Movie.id, literal(0.5).label('weight'))
+            .join(Movie, func.lower(Movie.title) == func.lower(SearchHistory.query))
+        )
+        result = await db.execute(favorites.union_all(searches))
+        return result.all()
+
+    async def replace_all(self, db: AsyncSession, rows: List[Dict[str, Any]]):
+        """
+        Заменяет все рекомендации новым набором в одной транзакции.
+        """
+        await db.execute(delete(self.model))
+        if rows:
+            await db.execute(insert(self.model), rows)
+        await db.commit()
+
 class CRUDSearchHistory(CRUDBase):
     def __init__(self):
         super().__init__(SearchHistory)
@@ -166,4 +552,153 @@ class CRUDSearchHistory(CRUDBase):
         Возвращает историю поиска пользователя.
         """
         result = await db.execute(select(self.model).filter(self.model.user_id == user_id))
-        return result.scalars().all()
\ No newline at end of file
+        return result.scalars().all()
+
+    async def bulk_record(self, db: AsyncSession, searches: List[tuple], commit: bool = True):
+        """
+        Сохраняет пачку поисков (telegram_id, query) одним INSERT ... SELECT;
+        поиски незарегистрированных пользователей пропускаются.
+        """
+        if not searches:
+            return
+        batch = values(
+            column('telegram_id', BigInteger), column('query', String), name='batch'
+        ).data([(telegram_id, query[:255]) for telegram_id, query in searches])
+        await db.execute(
+            insert(SearchHistory).from_select(
+                ['user_id', 'query'],
+                select(User.id, batch.c.query).join_from(batch, User, User.telegram_id == batch.c.telegram_id)
+            )
+        )
+        if commit:
+            await db.commit()
+
+class CRUDMailingJob(CRUDBase):
+    def __init__(self):
+        super().__init__(MailingJob)
+
+    async def create_job(self, db: AsyncSession, text: str, created_by: int,
+                         progress_chat_id: int = None, progress_message_id: int = None):
+        """
+        Создает задание рассылки и снимок получателей одним INSERT ... SELECT.
+        """
+        job = MailingJob(
+            text=text,
+            status='running',
+            created_by=created_by,
+            progress_chat_id=progress_chat_id,
+            progress_message_id=progress_message_id,
+        )
+        db.add(job)
+        await db.flush()
+
+        recipients = (
+            select(literal(job.id), User.telegram_id)
+            .where(User.telegram_id != created_by, User.is_active.is_(True))
+        )
+        result = await db.execute(
+            insert(MailingRecipient)
+            .from_select(['job_id', 'telegram_id'], recipients)
+            .on_conflict_do_nothing()
+        )
+        job.total = result.rowcount
+        await db.commit()
+        return job
+
+    async def get_by_status(self, db: AsyncSession, *statuses: str):
+        """
+        Возвращает задания в указанных статусах.
+        """
+        result = await db.execute(
+            select(self.model).filter(self.model.status.in_(statuses)).order_by(self.model.id)
+        )
+        return result.scalars().all()
+
+    async def get_pending_recipients(self, db: AsyncSession, job_id: int) -> List[int]:
+        """
+        Возвращает telegram_id получателей, которым сообщение еще не отправлено.
+        """
+        result = await db.execute(
+            select(MailingRecipient.telegram_id)
+            .filter(MailingRecipient.job_id == job_id, MailingRecipient.status == 'pending')
+            .order_by(MailingRecipient.telegram_id)
+        )
+        return result.scalars().all()
+
+    async def set_status(self, db: AsyncSession, job_id: int, status: str, only_from=None) -> bool:
+        """
+        Меняет статус задания. Если задан only_from, меняет только из перечисленных статусов.
+        Возвращает True, если статус изменен.
+        """
+        stmt = update(MailingJob).where(MailingJob.id == job_id)
+        if only_from:
+            stmt = stmt.where(MailingJob.status.in_(only_from))
+        result = await db.execute(stmt.values(status=status))
+        await db.commit()
+        return result.rowcount > 0
+
+    async def claim(self, db: AsyncSession, job_id: int, owner: str, lease: float) -> bool:
+        """
+        Атомарно берет задание в работу, если им не владеет другой живой процесс
+        (владелец без checkpoint дольше lease секунд считается упавшим).
+        Возвращает True, если задание получено.
+        """
+        result = await db.execute(
+            update(MailingJob)
+            .where(
+                MailingJob.id == job_id,
+                MailingJob.status == 'running',
+                or_(MailingJob.owner.is_(None), MailingJob.heartbeat_at < func.now() - timedelta(seconds=lease)),
+            )
+            .values(owner=owner, heartbeat_at=func.now())
+            .returning(MailingJob.id)
+        )
+        claimed = result.scalar() is not None
+        await db.commit()
+        return claimed
+
+    async def release(self, db: AsyncSession, job_id: int, owner: str):
+        """
+        Снимает аренду задания, если она все еще принадлежит owner.
+        """
+        await db.execute(
+            update(MailingJob)
+            .where(MailingJob.id == job_id, MailingJob.owner == owner)
+            .values(owner=None, heartbeat_at=None)
+        )
+        await db.commit()
+
+    async def checkpoint(self, db: AsyncSession, job_id: int, sent: List[int], failed: List[int],
+                         blocked: List[int] = (), owner: Optional[str] = None):
+        """
+        Фиксирует результаты отправки пачкой и обновляет счетчики задания.
+        Пользователи из blocked (бот заблокирован / аккаунт удален) помечаются неактивными.
+        Если задание арендовано owner, продлевает аренду.
+        Возвращает текущие (статус, владелец) задания.
+        """
+        if blocked:
+            await db.execute(
+                update(User).where(User.telegram_id.in_(blocked)).values(is_active=False)
+            )
+            for telegram_id in blocked:
+                profile_cache.pop(telegram_id)
+        for status, ids in (('sent', sent), ('failed', failed)):
+            if ids:
+                await db.execute(
+                    update(MailingRecipient)
+                    .where(MailingRecipient.job_id == job_id, MailingRecipient.telegram_id.in_(ids))
+                    .values(status=status)
+                )
+        result = await db.execute(
+            update(MailingJob)
+            .where(MailingJob.id == job_id)
+            .values(
+                success=MailingJob.success + len(sent),
+                failed=MailingJob.failed + len(failed),
+                heartbeat_at=case((MailingJob.owner == owner, func.now()), else_=MailingJob.heartbeat_at),
+            )
+            .returning(MailingJob.status, MailingJob.owner)
+        )
+        row = result.one()
+        await db.commit()
+        return row.status, row.owner
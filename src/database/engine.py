@@ -0,0 +1,67 @@
+import os
+from os import getenv
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+
+def _build_url(url: str):
+    """
+    Добавляет размер кэша подготовленных выражений asyncpg в строку подключения.
+    """
+    url = make_url(url)
+    if url.get_driver_name() == "asyncpg" and "prepared_statement_cache_size" not in url.query:
+        url = url.update_query_dict({
+            "prepared_statement_cache_size": getenv("DB_STATEMENT_CACHE_SIZE", "500")
+        })
+    return url
+
+
+# В режиме sharded у каждого процесса-воркера свой пул: DB_POOL_SIZE и DB_MAX_OVERFLOW
+# задают общий бюджет соединений бота и делятся между воркерами
+# (иначе BOT_WORKERS x 20 соединений легко превышают max_connections Postgres).
+# Воркеру нужно не меньше 2 + 1 соединений (запись в каталог идет отдельной сессией),
+# поэтому минимальный бюджет - 3 x BOT_WORKERS соединений
+_POOL_SHARES = int(getenv("BOT_WORKERS", str(min(os.cpu_count() or 1, 4)))) if getenv("BOT_MODE") == "sharded" else 1
+
+# Единственный движок и пул соединений на весь процесс
+engine = create_async_engine(
+    _build_url(getenv("PG_URL")),
+    echo=getenv("DB_ECHO", "false").lower() in ("1", "true", "yes"),
+    pool_size=max(2, int(getenv("DB_POOL_SIZE", "10")) // _POOL_SHARES),
+    max_overflow=max(1, int(getenv("DB_MAX_OVERFLOW", "10")) // _POOL_SHARES),
+    pool_timeout=float(getenv("DB_POOL_TIMEOUT", "30")),
+    pool_recycle=int(getenv("DB_POOL_RECYCLE", "1800")),
+    pool_pre_ping=getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+)
+
+# Фабрика асинхронных сессий
+async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+
+
+class LazySession:
+    """
+    Прокси AsyncSession для DI в хендлеры: сессия создается при первом обращении,
+    поэтому апдейты, которые не работают с БД, не занимают ресурсы пула.
+    """
+
+    def __init__(self, session_maker: async_sessionmaker = async_session_maker):
+        self._session_maker = session_maker
+        self._session = None
+
+    @property
+    def started(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name):
+        if self._session is None:
+            self._session = self._session_maker()
+        return getattr(self._session, name)
+
+    async def close(self):
+        """
+        Закрывает сессию (если она создавалась) и возвращает соединение в пул.
+        """
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
@@ -1,6 +1,8 @@
 from sqlalchemy import (
-    Column, Integer, String, Text, Date, VARCHAR, TIMESTAMP, ForeignKey, Table, BigInteger, UniqueConstraint, Boolean
+    Column, Integer, String, Text, Date, VARCHAR, TIMESTAMP, ForeignKey, Table, BigInteger, UniqueConstraint, Boolean,
+    Float, Index, literal_column
 )
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -23,8 +25,9 @@ class User(Base):
     last_name = Column(VARCHAR(255))
     age = Column(Integer, nullable=True)
     sex = Column(String, nullable=True)
-    created_at = Column(TIMESTAMP, server_default=func.now())
+    created_at = Column(TIMESTAMP, server_default=func.now(), index=True)
     is_active = Column(Boolean, default=True, nullable=False)
+    last_seen_at = Column(TIMESTAMP, nullable=True, index=True)
 
     # Связь с избранными фильмами
     favorites = relationship('Favorite', back_populates='user')
@@ -37,7 +40,13 @@ class Movie(Base):
     overview = Column(Text)
     release_date = Column(Date)
     poster_url = Column(String(255))
+    # file_id постера, уже загруженного в Telegram (повторная отправка без скачивания)
+    poster_file_id = Column(String(255))
     tmdb_id = Column(Integer, unique=True)
+    kinopoisk_id = Column(Integer, unique=True)
+    year = Column(Integer)
+    rating = Column(Float)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
 
     # Связь с избранными фильмами
     favorites = relationship('Favorite', back_populates='movie')
@@ -45,6 +54,11 @@ class Movie(Base):
     # Связь с жанрами (многие-ко-многим)
     genres = relationship('Genre', secondary=movie_genre_association, back_populates='movies')
 
+# Индексы для нечеткого поиска по названию: триграммы (опечатки) и полнотекстовый по-русски.
+# Требуют расширения pg_trgm (создается в init_db.create_tables)
+Index('ix_movies_title_trgm', Movie.title, postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+Index('ix_movies_title_tsv', func.to_tsvector(literal_column("'russian'::regconfig"), Movie.title), postgresql_using='gin')
+
 class Genre(Base):
     __tablename__ = 'genres'
 
@@ -69,8 +83,10 @@ class Favorite(Base):
     movie = relationship('Movie', back_populates='favorites')
 
     # Уникальный индекс для пары user_id и movie_id
+    # и индекс для постраничного вывода избранного (keyset по added_at, id)
     __table_args__ = (
         UniqueConstraint('user_id', 'movie_id', name='unique_user_movie'),
+        Index('ix_favorites_user_added', 'user_id', 'added_at', 'id'),
     )
 
 class Recommendation(Base):
@@ -79,6 +95,7 @@ class Recommendation(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False)
+    score = Column(Float, nullable=False, default=0)
     created_at = Column(TIMESTAMP, server_default=func.now())
 
     # Связь с пользователем
@@ -87,13 +104,59 @@ class Recommendation(Base):
     # Связь с фильмом
     movie = relationship('Movie')
 
+    # Рекомендации пользователя читаются одним запросом по индексу
+    __table_args__ = (
+        Index('ix_recommendations_user_score', 'user_id', 'score'),
+    )
+
 class SearchHistory(Base):
     __tablename__ = 'search_history'
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     query = Column(String(255), nullable=False)
-    searched_at = Column(TIMESTAMP, server_default=func.now())
+    searched_at = Column(TIMESTAMP, server_default=func.now(), index=True)
 
     # Связь с пользователем
-    user = relationship('User')
\ No newline at end of file
+    user = relationship('User')
+
+class MailingJob(Base):
+    __tablename__ = 'mailing_jobs'
+
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    # running / paused / cancelled / done
+    status = Column(String(16), nullable=False, default='running', index=True)
+    created_by = Column(BigInteger, nullable=False)
+    # Сообщение админа, в котором показывается прогресс
+    progress_chat_id = Column(BigInteger)
+    progress_message_id = Column(Integer)
+    total = Column(Integer, nullable=False, default=0)
+    success = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    # Процесс, выполняющий задание, и время его последнего checkpoint (аренда задания)
+    owner = Column(String(64))
+    heartbeat_at = Column(TIMESTAMP)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+class MailingRecipient(Base):
+    __tablename__ = 'mailing_recipients'
+
+    job_id = Column(Integer, ForeignKey('mailing_jobs.id', ondelete='CASCADE'), primary_key=True)
+    telegram_id = Column(BigInteger, primary_key=True)
+    # pending / sent / failed
+    status = Column(String(16), nullable=False, default='pending')
+
+    __table_args__ = (
+        Index('ix_mailing_recipients_pending', 'job_id', 'status'),
+    )
+
+# Состояния FSM aiogram, общие для всех процессов бота
+class FSMRecord(Base):
+    __tablename__ = 'fsm_states'
+
+    key = Column(String(255), primary_key=True)
+    state = Column(String(255), nullable=True)
+    data = Column(JSONB, nullable=False, server_default='{}')
+    expires_at = Column(TIMESTAMP, nullable=False, index=True)
@@ -2,22 +2,31 @@ from aiogram.filters import Command, Filter
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
 
 
-from src.keyboards.keyboards import admin_panel, cancel_kb, confirm_kb
+from src.keyboards.keyboards import admin_panel, cancel_kb, confirm_kb, mailing_job_kb
 
 from config import admins
 
-from src.database.models import User
-from sqlalchemy import select
 import asyncio
-from init_db import async_session_maker
+from os import getenv
+from src.database.engine import async_session_maker
+from src.utils.broadcast import telegram_bucket
+from src.utils.mailing import MailingRunner, mailing_cancelled_text, mailing_progress_text
+from src.database.crud import CRUDMailingJob, CRUDUser
+from src.utils.cache import TTLCache
+from src.handlers.search import film_cache, search_cache, flight
 
 
 admin_router = Router()
 
+# Статистика кэшируется ненадолго: экран открывают часто, а цифры меняются медленно
+stats_cache = TTLCache(maxsize=1, ttl=float(getenv("STATS_CACHE_TTL", "60")))
+crud_user = CRUDUser()
+
 # Лучше хранить админов в базе данных или конфиге
 ADMINS_IDS = admins
 
@@ -60,27 +69,65 @@ async def go_back(callback: CallbackQuery):
     await callback.answer()
 
 
+def runtime_stats_text(fsm_storage: BaseStorage = None) -> str:
+    """Эффективность кэшей и объединения запросов в текущем процессе"""
+    films = film_cache.stats()
+    api = flight.stats()
+    lines = [
+        "⚙️ Этот процесс:",
+        f"🎬 Кэш фильмов: {films['size']} шт., попаданий {films['hit_rate']:.0%}",
+    ]
+    if hasattr(search_cache, "stats"):
+        searches = search_cache.stats()
+        lines.append(f"🔎 Кэш поиска: {searches['size']} шт., попаданий {searches['hit_rate']:.0%}")
+    lines.append(f"🔗 Запросов к API объединено: {api['coalesced']} из {api['calls']}")
+    if hasattr(fsm_storage, "stats"):
+        fsm = fsm_storage.stats()
+        lines.append(f"🗂 Состояний FSM: {fsm['live']}, удалено неактивных {fsm['evicted']}")
+    return "\n".join(lines)
+
+
 @admin_router.callback_query(F.data == "admin_stats")
-async def show_statistics(callback: CallbackQuery):
+async def show_statistics(callback: CallbackQuery, fsm_storage: BaseStorage = None):
     """Показ статистики бота"""
-    async with async_session_maker() as session:
-        result = await session.stream(select(User.telegram_id))
-        user_ids = [user.telegram_id async for user in result]
-        total_users = len(user_ids)
-        # Здесь можно получить реальную статистику из БД
-        stats_text = (
-            f"📊 Статистика бота:\n\n"
-            f"👥 Всего пользователей: {total_users}\n"
-            f"🟢 Активных за месяц: 256\n"
-            f"🔴 Новых сегодня: 12\n"
-            f"📝 Сообщений сегодня: 345"
-        )
-        
-        back_button = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ])
-        
-        await callback.message.edit_text(stats_text, reply_markup=back_button)
+    stats = stats_cache.get("stats")
+    if stats is None:
+        async with async_session_maker() as session:
+            stats = await crud_user.get_stats(session)
+        stats_cache.set("stats", stats)
+
+    stats_text = (
+        f"📊 Статистика бота:\n\n"
+        f"👥 Всего пользователей: {stats['total']}\n"
+        f"🟢 Активных за месяц: {stats['active_month']}\n"
+        f"🔴 Новых сегодня: {stats['new_today']}\n"
+        f"🔎 Поисков сегодня: {stats['searches_today']}\n"
+        f"🚫 Заблокировали бота: {stats['blocked']}\n\n"
+        f"{runtime_stats_text(fsm_storage)}"
+    )
+    
+    back_button = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+    ])
+    
+    await callback.message.edit_text(stats_text, reply_markup=back_button)
+    await callback.answer()
+
+# Параметры рассылки: число воркеров и период обновления прогресса (сек)
+MAILING_WORKERS = int(getenv("MAILING_WORKERS", "20"))
+MAILING_PROGRESS_INTERVAL = float(getenv("MAILING_PROGRESS_INTERVAL", "3"))
+# Через сколько секунд без checkpoint задание упавшего процесса может взять другой
+MAILING_LEASE_TIMEOUT = float(getenv("MAILING_LEASE_TIMEOUT", "60"))
+
+# Задания рассылки хранятся в БД и переживают перезапуск бота
+mailing_runner = MailingRunner(
+    async_session_maker,
+    telegram_bucket,
+    workers=MAILING_WORKERS,
+    progress_interval=MAILING_PROGRESS_INTERVAL,
+    lease_timeout=MAILING_LEASE_TIMEOUT
+)
+crud_mailing = CRUDMailingJob()
 
 class MailingStates(StatesGroup):
     WAITING_TEXT = State()
@@ -134,71 +181,80 @@ async def execute_mailing(callback: CallbackQuery, state: FSMContext, bot: Bot):
     progress_msg = await callback.message.edit_text("⏳ Подготовка к рассылке...")
     await callback.answer()
     
-    # Используем асинхронную сессию
-    async with async_session_maker() as session:
-        # Получаем только необходимые данные (telegram_id)
-        result = await session.execute(select(User.telegram_id))
-        user_ids = [uid for uid in result.scalars().all() if uid != admin_id]
-        total_users = len(user_ids)
-        
-        success = 0
-        failed = 0
-        batch_size = 50  # Размер батча для обновления прогресса
-        
-        for i, user_id in enumerate(user_ids, 1):
-            try:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=mailing_text,
-                    parse_mode="HTML"
-                )
-                success += 1
-            except TelegramForbiddenError:
-                # Пользователь заблокировал бота
-                failed += 1
-            except TelegramRetryAfter as e:
-                # Превышены лимиты - делаем паузу
-                await asyncio.sleep(e.retry_after)
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=mailing_text,
-                        parse_mode="HTML"
-                    )
-                    success += 1
-                except Exception:
-                    failed += 1
-            except Exception as e:
-                print(f"Ошибка при отправке пользователю {user_id}: {str(e)}")
-                failed += 1
-            
-            # Обновляем прогресс
-            if i % batch_size == 0 or i == total_users:
-                progress = min(i / total_users * 100, 100)
-                await progress_msg.edit_text(
-                    f"⏳ Рассылка в процессе...\n\n"
-                    f"▰{'▰' * int(progress // 10)}{'▱' * (10 - int(progress // 10))}\n"
-                    f"📊 {i}/{total_users} ({progress:.1f}%)\n"
-                    f"✅ {success} | ❌ {failed}"
-                )
-            
-            # Оптимальная задержка между сообщениями
-            await asyncio.sleep(0.03)
-    
-    # Формируем финальный отчет
-    report = (
-        f"📊 <b>Отчет о рассылке</b>\n\n"
-        f"▪️ Всего пользователей: {total_users}\n"
-        f"✅ Успешно отправлено: {success}\n"
-        f"❌ Не удалось отправить: {failed}\n\n"
-        f"<i>Последняя рассылка завершена</i>"
+    job_id = await mailing_runner.create(
+        mailing_text,
+        created_by=admin_id,
+        chat_id=progress_msg.chat.id,
+        message_id=progress_msg.message_id
     )
-    
     await progress_msg.edit_text(
-        report,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 В админ-панель", callback_data="admin_back")]
-        ]),
-        parse_mode="HTML"
+        f"⏳ Рассылка #{job_id} запущена",
+        reply_markup=mailing_job_kb(job_id, 'running')
     )
-    await state.clear()
\ No newline at end of file
+    mailing_runner.start(bot, job_id)
+    await state.clear()
+
+
+@admin_router.callback_query(F.data == "admin_mailing_jobs")
+async def show_mailing_jobs(callback: CallbackQuery):
+    """Список незавершенных рассылок"""
+    async with async_session_maker() as session:
+        jobs = await crud_mailing.get_by_status(session, 'running', 'paused')
+
+    if not jobs:
+        await callback.message.edit_text(
+            "Нет активных рассылок",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+            ])
+        )
+    else:
+        for job in jobs:
+            await callback.message.answer(
+                mailing_progress_text(
+                    job.id, job.total, job.success + job.failed, job.success, job.failed,
+                    paused=job.status == 'paused'
+                ),
+                reply_markup=mailing_job_kb(job.id, job.status)
+            )
+    await callback.answer()
+
+
+@admin_router.callback_query(F.data.startswith("mailing_"))
+async def control_mailing(callback: CallbackQuery, bot: Bot):
+    """Пауза, продолжение и отмена рассылки"""
+    _, action, job_id = callback.data.split("_")
+    job_id = int(job_id)
+
+    if action == "pause":
+        changed = await mailing_runner.pause(job_id)
+    elif action == "resume":
+        changed = await mailing_runner.resume(bot, job_id)
+    elif action == "cancel":
+        changed = await mailing_runner.cancel(job_id)
+    else:
+        changed = False
+
+    if not changed:
+        await callback.answer("Рассылка уже завершена или статус не изменился")
+        return
+
+    async with async_session_maker() as session:
+        job = await crud_mailing.get(session, job_id)
+
+    if job.status == 'cancelled':
+        await callback.message.edit_text(
+            mailing_cancelled_text(job_id, job.total, job.success, job.failed),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 В админ-панель", callback_data="admin_back")]
+            ])
+        )
+    else:
+        await callback.message.edit_text(
+            mailing_progress_text(
+                job.id, job.total, job.success + job.failed, job.success, job.failed,
+                paused=job.status == 'paused'
+            ),
+            reply_markup=mailing_job_kb(job.id, job.status)
+        )
+    await callback.answer()
@@ -0,0 +1,115 @@
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import F, Router
+from aiogram.types import CallbackQuery
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.crud import CRUDFavorite, CRUDMovie, CRUDUser
+from src.handlers.search import get_film_details
+from src.keyboards.keyboards import film_actions_kb
+
+router = Router()
+
+crud_favorite = CRUDFavorite()
+crud_movie = CRUDMovie()
+crud_user = CRUDUser()
+
+FAVORITES_PAGE_SIZE = 10
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(cursor: tuple) -> str:
+    """Курсор (added_at, id) -> компактная строка для callback_data"""
+    added_at, favorite_id = cursor
+    return f"{(added_at - _EPOCH) // timedelta(microseconds=1)}_{favorite_id}"
+
+
+def decode_cursor(value: str) -> tuple:
+    micros, favorite_id = value.split("_")
+    return _EPOCH + timedelta(microseconds=int(micros)), int(favorite_id)
+
+
+async def _resolve(callback: CallbackQuery, session: AsyncSession, film_id: str):
+    """Возвращает (id пользователя, фильм из каталога) для кнопок избранного"""
+    profile = await crud_user.get_profile(session, callback.from_user.id)
+    if not profile:
+        await callback.answer("Сначала зарегистрируйтесь: /start", show_alert=True)
+        return None, None
+    
+    movie = await crud_movie.get_by_kinopoisk_id(session, int(film_id))
+    if movie is None:
+        # Фильма еще нет в каталоге - загрузка карточки сохранит его
+        await get_film_details(film_id, session)
+        movie = await crud_movie.get_by_kinopoisk_id(session, int(film_id))
+    if movie is None:
+        await callback.answer("Не удалось найти фильм")
+    return profile['id'], movie
+
+
+@router.callback_query(F.data.startswith("fav_add_"))
+async def add_favorite(callback: CallbackQuery, session: AsyncSession):
+    film_id = callback.data.split("_")[2]
+    user_id, movie = await _resolve(callback, session, film_id)
+    if movie is None:
+        return
+    
+    await crud_favorite.add(session, user_id, movie.id)
+    await callback.message.edit_reply_markup(reply_markup=film_actions_kb(film_id, is_favorite=True))
+    await callback.answer("Добавлено в избранное")
+
+
+@router.callback_query(F.data.startswith("fav_del_"))
+async def remove_favorite(callback: CallbackQuery, session: AsyncSession):
+    film_id = callback.data.split("_")[2]
+    user_id, movie = await _resolve(callback, session, film_id)
+    if movie is None:
+        return
+    
+    await crud_favorite.remove(session, user_id, movie.id)
+    await callback.message.edit_reply_markup(reply_markup=film_actions_kb(film_id))
+    await callback.answer("Удалено из избранного")
+
+
+@router.callback_query(F.data == "favorites")
+@router.callback_query(F.data.startswith("fav_page_"))
+async def show_favorites(callback: CallbackQuery, session: AsyncSession):
+    profile = await crud_user.get_profile(session, callback.from_user.id)
+    if not profile:
+        await callback.answer("Сначала зарегистрируйтесь: /start", show_alert=True)
+        return
+    
+    after = None
+    if callback.data.startswith("fav_page_"):
+        try:
+            after = decode_cursor(callback.data[len("fav_page_"):])
+        except ValueError as e:
+            logging.error(f"Bad favorites cursor {callback.data}: {e}")
+    
+    favorites, next_cursor = await crud_favorite.get_page(
+        session, profile['id'], limit=FAVORITES_PAGE_SIZE, after=after
+    )
+    
+    if not favorites and after is None:
+        await callback.message.answer("В избранном пока пусто")
+        await callback.answer()
+        return
+    
+    builder = InlineKeyboardBuilder()
+    for favorite in favorites:
+        movie = favorite.movie
+        year = f" ({movie.year})" if movie.year else ""
+        builder.button(text=f"{movie.title}{year}", callback_data=f"film_{movie.kinopoisk_id}")
+    if next_cursor:
+        builder.button(text="Далее ▶️", callback_data=f"fav_page_{encode_cursor(next_cursor)}")
+    if after is not None:
+        builder.button(text="⏮ В начало", callback_data="favorites")
+    builder.adjust(1)
+    
+    text = "⭐ Избранное:" if favorites else "Больше ничего нет"
+    if after is None:
+        await callback.message.answer(text, reply_markup=builder.as_markup())
+    else:
+        await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    await callback.answer()
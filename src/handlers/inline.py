@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Any, Dict
+
+from aiogram import Router
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InlineQueryResultPhoto, InputTextMessageContent
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.handlers.search import film_caption, search_local, search_movies
+
+router = Router()
+
+# Пауза после последнего нажатия клавиши, прежде чем искать
+INLINE_DEBOUNCE = float(getenv("INLINE_DEBOUNCE", "0.4"))
+# Сколько секунд Telegram может отдавать ответ на тот же запрос из своего кэша
+INLINE_CACHE_TIME = int(getenv("INLINE_CACHE_TIME", "3600"))
+
+# Текущий поиск каждого пользователя: новый запрос отменяет предыдущий
+_pending: Dict[int, asyncio.Task] = {}
+
+
+def inline_result(film: Dict[str, Any]):
+    """Фильм -> результат inline-запроса (с постером, если он есть)"""
+    title = f"{film['name']} ({film['year']})" if film['year'] else film['name']
+    description = f"⭐ {film['rating']} | {film['genre']}"
+    if film.get('poster'):
+        return InlineQueryResultPhoto(
+            id=film['id'],
+            photo_url=film['poster'],
+            thumbnail_url=film['poster'],
+            title=title,
+            description=description,
+            caption=film_caption(film),
+            parse_mode="HTML"
+        )
+    return InlineQueryResultArticle(
+        id=film['id'],
+        title=title,
+        description=description,
+        input_message_content=InputTextMessageContent(message_text=film_caption(film), parse_mode="HTML")
+    )
+
+
+async def _answer(inline_query: InlineQuery, session: AsyncSession):
+    # Пока пользователь печатает, каждый следующий запрос отменяет этот
+    await asyncio.sleep(INLINE_DEBOUNCE)
+
+    query = inline_query.query.strip()
+    films = await search_local(query, session) or await search_movies(query)
+    await inline_query.answer(
+        [inline_result(film) for film in films if film.get('id')],
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False
+    )
+
+
+@router.inline_query()
+async def inline_search(inline_query: InlineQuery, session: AsyncSession):
+    if len(inline_query.query.strip()) < 2:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=False)
+        return
+
+    user_id = inline_query.from_user.id
+    previous = _pending.get(user_id)
+    if previous is not None:
+        previous.cancel()
+
+    task = asyncio.create_task(_answer(inline_query, session))
+    _pending[user_id] = task
+    try:
+        # wait, а не await: отмена устаревшего поиска не считается ошибкой хендлера
+        await asyncio.wait([task])
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        if _pending.get(user_id) is task:
+            del _pending[user_id]
+
+    if task.cancelled():
+        logging.debug(f"Inline query from {user_id} superseded")
+        return
+    task.result()
@@ -1,18 +1,71 @@
-import requests
+import re
+import hashlib
 import random
+import asyncio
 import logging
-from os import getenv
 from typing import Dict, Any, Optional, List
 
+import aiohttp
+from os import getenv
+from datetime import timedelta
+
 from aiogram import F, Router
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.utils.kinopoisk import kinopoisk
+from src.utils.cache import TTLCache, BaseCache, MemoryCache
+from src.utils.prefetch import PrefetchPool
+from src.utils.singleflight import SingleFlight
+from src.database.crud import CRUDMovie, CRUDUser, CRUDRecommendation
+from src.database.engine import async_session_maker
+from src.utils.activity import activity
+from src.keyboards.keyboards import film_actions_kb
 
 router = Router()
-HEADERS = {"X-API-KEY": getenv("KNP_API")}
-KINOPOISK_API_URL = "https://api.kinopoisk.dev/v1.4"
+
+# Кэш карточек фильмов по id Кинопоиска (метаданные почти не меняются)
+film_cache = TTLCache(
+    maxsize=int(getenv("FILM_CACHE_SIZE", "2048")),
+    ttl=float(getenv("FILM_CACHE_TTL", "86400"))
+)
+
+# Кэш результатов поиска по нормализованному запросу
+search_cache: BaseCache = MemoryCache(
+    maxsize=int(getenv("SEARCH_CACHE_SIZE", "4096")),
+    ttl=float(getenv("SEARCH_CACHE_TTL", "21600"))
+)
+# Пустые результаты храним недолго, чтобы не дергать API на повторных промахах
+SEARCH_NEGATIVE_TTL = float(getenv("SEARCH_NEGATIVE_TTL", "600"))
+
+# Результаты поиска запрашиваются одним окном и листаются из памяти
+SEARCH_WINDOW = int(getenv("SEARCH_WINDOW", "30"))
+SEARCH_PAGE_SIZE = int(getenv("SEARCH_PAGE_SIZE", "5"))
+# Окна результатов по короткому токену из callback_data
+search_windows = TTLCache(
+    maxsize=int(getenv("SEARCH_WINDOWS_SIZE", "4096")),
+    ttl=float(getenv("SEARCH_WINDOWS_TTL", "3600"))
+)
+
+# Локальный каталог фильмов: записи старше этого срока перезапрашиваются из API
+CATALOG_MAX_AGE = timedelta(days=float(getenv("CATALOG_MAX_AGE_DAYS", "7")))
+# Минимальная уверенность локального поиска, ниже которой идем в API
+LOCAL_SEARCH_MIN_SCORE = float(getenv("LOCAL_SEARCH_MIN_SCORE", "0.5"))
+crud_movie = CRUDMovie()
+
+# file_id постеров, уже загруженных в Telegram, по id фильма
+poster_file_ids = TTLCache(
+    maxsize=int(getenv("POSTER_CACHE_SIZE", "10000")),
+    ttl=float(getenv("POSTER_CACHE_TTL", str(7 * 24 * 3600)))
+)
+crud_user = CRUDUser()
+crud_recommendation = CRUDRecommendation()
+
+# Одинаковые одновременные запросы к API выполняются один раз
+flight = SingleFlight()
 
 class MovieStates(StatesGroup):
     waiting_for_title = State()
@@ -26,12 +79,20 @@ MAIN_GENRES = {
     "ужасы": "horror"
 }
 
-async def get_random_movie(genre: str = None) -> Optional[Dict[str, Any]]:
+# Случайная страница выдачи берется из первых RANDOM_MAX_PAGES (или из всех, если их меньше)
+RANDOM_MAX_PAGES = int(getenv("RANDOM_MAX_PAGES", "50"))
+# Сколько страниц реально есть у выдачи по жанру - узнаем из ответов API
+_random_pages: Dict[Optional[str], int] = {}
+
+async def fetch_random_films(genre: str = None) -> List[Dict[str, Any]]:
+    """Загружает пачку фильмов (по жанру или без) и нормализует их все"""
     logging.debug(f"Searching for genre: {genre}")
     try:
-        # Базовые параметры запроса
+        # Базовые параметры запроса; страница случайная, иначе пул
+        # пополнялся бы одними и теми же 10 фильмами
         params = {
             "limit": 10,
+            "page": random.randint(1, _random_pages.get(genre, RANDOM_MAX_PAGES)),
             "selectFields": ["id", "name", "year", "rating", "genres", "poster"],
             "type": "movie",
             "notNullFields": ["name", "poster.url"]
@@ -44,38 +105,45 @@ async def get_random_movie(genre: str = None) -> Optional[Dict[str, Any]]:
         # Логируем URL перед запросом для отладки
         logging.debug(f"Request params: {params}")
         
-        response = requests.get(
-            f"{KINOPOISK_API_URL}/movie",
-            headers=HEADERS,
-            params=params,
-            timeout=15
-        )
-        
-        logging.debug(f"Full request URL: {response.url}")
-        logging.debug(f"Response status: {response.status_code}")
-        
-        if response.status_code == 400:
-            error_data = response.json()
-            logging.error(f"API validation error: {error_data}")
-            return None
-            
-        response.raise_for_status()
+        data = await kinopoisk.get("/movie", params=params, timeout=15)
+        _random_pages[genre] = max(1, min(data.get('pages') or 1, RANDOM_MAX_PAGES))
         
-        films = response.json().get('docs', [])
+        films = data.get('docs', [])
         logging.debug(f"Found {len(films)} films for genre '{genre}'")
         
-        if not films:
-            return None
-            
-        selected_film = random.choice(films)
-        return normalize_film_data(selected_film)
+        results = [film for film in map(normalize_film_data, films) if film]
+        await save_films(results)
+        return results
         
-    except requests.exceptions.RequestException as e:
+    except aiohttp.ClientResponseError as e:
+        if e.status == 400:
+            logging.error(f"API validation error: {e.message}")
+        else:
+            logging.error(f"Request failed: {str(e)}")
+        return []
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logging.error(f"Request failed: {str(e)}")
-        return None
+        return []
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}", exc_info=True)
-        return None
+        return []
+
+# Фоновый пул готовых фильмов для каждого жанра и для случая без жанра
+random_pool = PrefetchPool(
+    fetch_random_films,
+    keys=[None, *MAIN_GENRES.values()],
+    low_water=int(getenv("RANDOM_POOL_LOW_WATER", "3")),
+    max_size=int(getenv("RANDOM_POOL_MAX_SIZE", "30")),
+    id_of=lambda film: film['id']
+)
+
+async def get_random_movie(genre: str = None) -> Optional[Dict[str, Any]]:
+    if genre in random_pool:
+        return await random_pool.pop(genre)
+    
+    # Жанр вне пула (например, подделанный callback) - обычный запрос
+    films = await flight.do(("random", genre), fetch_random_films, genre)
+    return random.choice(films) if films else None
     
 
 def normalize_film_data(film_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
@@ -101,49 +169,144 @@ def normalize_film_data(film_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         'year': str(film_data.get('year', '')),
         'rating': rating_kp,
         'poster': poster_url,
-        'genre': ', '.join(genre_names) if genre_names else 'не указан'
+        'genre': ', '.join(genre_names) if genre_names else 'не указан',
+        'genres': genre_names
     }
 
+async def save_films(films: List[Dict[str, Any]]):
+    """Записывает фильмы в локальный каталог; ошибка БД не мешает ответу пользователю"""
+    if not films:
+        return
+    try:
+        async with async_session_maker() as session:
+            await crud_movie.upsert_films(session, films)
+    except Exception as e:
+        logging.error(f"Catalog write error: {e}")
+
+def normalize_query(title: str) -> str:
+    """Ключ кэша поиска: регистр, лишние пробелы и ё/е не различаются"""
+    return re.sub(r"\s+", " ", title.casefold().replace("ё", "е")).strip()
+
 async def search_movies(title: str) -> List[Dict[str, Any]]:
+    key = normalize_query(title)
+    cached = await search_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    return await flight.do(("search", key), _search_remote, key, title)
+
+async def _search_remote(key: str, title: str) -> List[Dict[str, Any]]:
     try:
-        response = requests.get(
-            f"{KINOPOISK_API_URL}/movie/search",
-            headers=HEADERS,
+        data = await kinopoisk.get(
+            "/movie/search",
             params={
                 "query": title,
-                "limit": 5,
+                "limit": SEARCH_WINDOW,
                 "selectFields": ["id", "name", "alternativeName", "year", "rating.kp", "poster.url", "genres"]
             },
             timeout=10
         )
-        response.raise_for_status()
         
-        films = response.json().get('docs', [])
-        return [normalize_film_data(f) for f in films if f]
+        films = data.get('docs', [])
+        results = [normalize_film_data(f) for f in films if f]
+        await search_cache.set(key, results, ttl=None if results else SEARCH_NEGATIVE_TTL)
+        await save_films(results)
+        return results
         
     except Exception as e:
         logging.error(f"Search error: {e}")
         return []
 
-async def send_movie_info(message: Message, film: Dict[str, Any]):
-    if not film:
-        await message.answer("Не удалось загрузить информацию о фильме")
-        return
+async def search_local(title: str, session: AsyncSession) -> List[Dict[str, Any]]:
+    """Поиск по локальному каталогу; пустой список, если уверенность низкая"""
+    try:
+        matches = await crud_movie.search_title(session, title, limit=SEARCH_WINDOW)
+        films = [crud_movie.to_film(movie) for movie, score in matches if score >= LOCAL_SEARCH_MIN_SCORE]
+    except Exception as e:
+        logging.error(f"Local search error: {e}")
+        return []
+    finally:
+        # При промахе дальше идет запрос к API - соединение возвращаем в пул сразу
+        await session.rollback()
+    
+    if not matches or matches[0].score < LOCAL_SEARCH_MIN_SCORE:
+        return []
+    return films
+
+def store_search_window(title: str, films: List[Dict[str, Any]]) -> str:
+    """Сохраняет результаты поиска, возвращает токен для callback_data"""
+    token = hashlib.blake2b(normalize_query(title).encode(), digest_size=6).hexdigest()
+    search_windows.set(token, films)
+    return token
+
+def search_page(token: str, films: List[Dict[str, Any]], page: int):
+    """Текст и клавиатура страницы результатов поиска"""
+    pages = (len(films) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
     
-    text = (
+    builder = InlineKeyboardBuilder()
+    for film in films[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]:
+        builder.button(
+            text=f"{film['name']} ({film['year']})",
+            callback_data=f"film_{film['id']}"
+        )
+    builder.adjust(1)
+    
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"sp_{token}_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"sp_{token}_{page + 1}"))
+    if navigation:
+        builder.row(*navigation)
+    
+    text = "Выберите фильм:" if pages == 1 else f"Выберите фильм (стр. {page + 1}/{pages}):"
+    return text, builder.as_markup()
+
+def film_caption(film: Dict[str, Any]) -> str:
+    return (
         f"🎬 <b>{film['name']}</b>\n"
         f"📅 {film['year']} | ⭐ {film['rating']} | 🎭 {film['genre']}\n"
         f"🔗 https://www.kinopoisk.ru/film/{film['id']}/"
     )
+
+async def send_movie_info(message: Message, film: Dict[str, Any]):
+    if not film:
+        await message.answer("Не удалось загрузить информацию о фильме")
+        return
+    
+    text = film_caption(film)
+    
+    markup = film_actions_kb(film['id']) if film.get('id') else None
+    
+    file_id = poster_file_ids.get(film['id']) or film.get('poster_file_id')
+    if file_id:
+        try:
+            await message.answer_photo(file_id, caption=text, parse_mode="HTML", reply_markup=markup)
+            return
+        except Exception as e:
+            # file_id мог стать недействительным - отправим по URL
+            logging.warning(f"Cached poster failed for film {film['id']}: {e}")
+            poster_file_ids.pop(film['id'])
     
     try:
         if film.get('poster'):
-            await message.answer_photo(film['poster'], caption=text, parse_mode="HTML")
+            sent = await message.answer_photo(film['poster'], caption=text, parse_mode="HTML", reply_markup=markup)
+            await remember_poster(film['id'], sent.photo[-1].file_id)
         else:
-            await message.answer(text, parse_mode="HTML")
+            await message.answer(text, parse_mode="HTML", reply_markup=markup)
     except Exception as e:
         logging.error(f"Send error: {e}")
-        await message.answer(text, parse_mode="HTML")
+        await message.answer(text, parse_mode="HTML", reply_markup=markup)
+
+async def remember_poster(film_id: str, file_id: str):
+    """Запоминает file_id постера в памяти и в каталоге"""
+    poster_file_ids.set(film_id, file_id)
+    try:
+        async with async_session_maker() as session:
+            await crud_movie.set_poster_file_id(session, int(film_id), file_id)
+    except Exception as e:
+        logging.error(f"Poster file_id save error: {e}")
 
 @router.callback_query(F.data == "random_movie")
 async def handle_random(callback: CallbackQuery):
@@ -175,46 +338,81 @@ async def start_search(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(MovieStates.waiting_for_title)
-async def process_search(message: Message, state: FSMContext):
+async def process_search(message: Message, state: FSMContext, session: AsyncSession):
     title = message.text.strip()
     if len(title) < 2:
         await message.answer("Слишком короткое название")
         return
     
-    films = await search_movies(title)
+    activity.record_search(message.from_user.id, title)
+    films = await search_local(title, session) or await search_movies(title)
     
     if not films:
         await message.answer("Ничего не найдено")
     elif len(films) == 1:
         await send_movie_info(message, films[0])
     else:
-        builder = InlineKeyboardBuilder()
-        for film in films:
-            builder.button(
-                text=f"{film['name']} ({film['year']})",
-                callback_data=f"film_{film['id']}"
-            )
-        builder.adjust(1)
-        await message.answer("Выберите фильм:", reply_markup=builder.as_markup())
+        token = store_search_window(title, films)
+        text, markup = search_page(token, films, 0)
+        await message.answer(text, reply_markup=markup)
     
     await state.clear()
 
+@router.callback_query(F.data.startswith("sp_"))
+async def show_search_page(callback: CallbackQuery):
+    _, token, page = callback.data.split("_")
+    films = search_windows.get(token)
+    if films is None:
+        await callback.answer("Результаты устарели, повторите поиск", show_alert=True)
+        return
+    
+    text, markup = search_page(token, films, int(page))
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer()
+
+async def get_film_details(film_id: str, session: AsyncSession) -> Optional[Dict[str, Any]]:
+    """Карточка фильма по id: кэш, затем локальный каталог, иначе API"""
+    film = film_cache.get(film_id)
+    if film is not None:
+        return film
+    
+    try:
+        movie = await crud_movie.get_by_kinopoisk_id(session, int(film_id), max_age=CATALOG_MAX_AGE)
+        film = crud_movie.to_film(movie) if movie is not None else None
+    except Exception as e:
+        logging.error(f"Catalog read error: {e}")
+        film = None
+    finally:
+        # Завершаем чтение: соединение не должно висеть idle in transaction
+        # на время запросов к API и отправки в Telegram
+        await session.rollback()
+    if film is not None:
+        film_cache.set(film_id, film)
+        return film
+    
+    return await flight.do(("film", film_id), _fetch_film, film_id)
+
+async def _fetch_film(film_id: str) -> Optional[Dict[str, Any]]:
+    data = await kinopoisk.get(
+        f"/movie/{film_id}",
+        params={
+            "selectFields": ["id", "name", "alternativeName", "year", "rating.kp", "poster.url", "genres"]
+        },
+        timeout=10
+    )
+    
+    film = normalize_film_data(data)
+    if film:
+        film_cache.set(film_id, film)
+        await save_films([film])
+    return film
+
 @router.callback_query(F.data.startswith("film_"))
-async def show_details(callback: CallbackQuery):
+async def show_details(callback: CallbackQuery, session: AsyncSession):
     film_id = callback.data.split("_")[1]
     
     try:
-        response = requests.get(
-            f"{KINOPOISK_API_URL}/movie/{film_id}",
-            headers=HEADERS,
-            params={
-                "selectFields": ["id", "name", "alternativeName", "year", "rating.kp", "poster.url", "genres"]
-            },
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        film = normalize_film_data(response.json())
+        film = await get_film_details(film_id, session)
         if film:
             await send_movie_info(callback.message, film)
         else:
@@ -233,4 +431,22 @@ async def show_genres(callback: CallbackQuery):
         builder.button(text=name.capitalize(), callback_data=f"genre_{genre_id}")
     builder.adjust(2)
     await callback.message.answer("Выберите жанр:", reply_markup=builder.as_markup())
-    await callback.answer()
\ No newline at end of file
+    await callback.answer()
+
+@router.callback_query(F.data == "recommendations")
+async def show_recommendations(callback: CallbackQuery, session: AsyncSession):
+    """Рекомендации, заранее посчитанные src.utils.recommender"""
+    profile = await crud_user.get_profile(session, callback.from_user.id)
+    recommendations = await crud_recommendation.get_by_user(session, profile['id'], limit=10) if profile else []
+    films = [r.movie for r in recommendations if r.movie.kinopoisk_id]
+    
+    if not films:
+        await callback.message.answer("Пока нечего рекомендовать. Ищите фильмы и добавляйте их в избранное")
+    else:
+        builder = InlineKeyboardBuilder()
+        for movie in films:
+            year = f" ({movie.year})" if movie.year else ""
+            builder.button(text=f"{movie.title}{year}", callback_data=f"film_{movie.kinopoisk_id}")
+        builder.adjust(1)
+        await callback.message.answer("Рекомендуем вам:", reply_markup=builder.as_markup())
+    await callback.answer()
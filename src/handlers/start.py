@@ -25,8 +25,10 @@ async def cmd_start(message: types.Message, state: FSMContext, session: AsyncSes
     crud_user = CRUDUser()
 
     # Проверяем, зарегистрирован ли пользователь
-    user = await crud_user.get_by_telegram_id(session, user_id)
+    user = await crud_user.get_profile(session, user_id)
     if user:
+        # Вернувшегося после блокировки пользователя снова делает активным
+        # ActivityWriter (CRUDUser.touch_many), независимо от кэша профилей
         await message.answer("Вы в главном меню:", reply_markup=main_menu_keyboard())
         await state.set_state(Main_menu.waiting_for_field)
         return
@@ -70,10 +72,11 @@ async def process_sex(message: types.Message, state: FSMContext, session: AsyncS
     age = user_data['age']
     user_id = message.from_user.id
 
-    # Создаем пользователя в базе данных
+    # Создаем пользователя в базе данных (повторный /start при регистрации не приведет к ошибке)
     crud_user = CRUDUser()
-    await crud_user.create(
+    await crud_user.upsert(
         session,
+        index_elements=['telegram_id'],
         telegram_id=user_id,
         username=message.from_user.username,
         first_name=name,
@@ -140,7 +143,7 @@ async def process_new_name(message: types.Message, state: FSMContext, session: A
     crud_user = CRUDUser()
 
     logging.info(f"Updating name for user {user_id} to {new_name}")
-    await crud_user.update(session, user_id, first_name=new_name)
+    await crud_user.update_returning(session, {'telegram_id': user_id}, first_name=new_name)
 
     await message.answer(f"Имя успешно обновлено на {new_name}!", reply_markup=main_menu_keyboard())
     await state.clear()
@@ -167,7 +170,7 @@ async def process_new_age(message: types.Message, state: FSMContext, session: As
         crud_user = CRUDUser()
 
         logging.info(f"Updating age for user {user_id} to {new_age}")
-        await crud_user.update(session, user_id, age=new_age)
+        await crud_user.update_returning(session, {'telegram_id': user_id}, age=new_age)
 
         await message.answer(f"Возраст успешно обновлен на {new_age}!", reply_markup=main_menu_keyboard())
         await state.clear()
@@ -195,7 +198,7 @@ async def process_new_sex(message: types.Message, state: FSMContext, session: As
     crud_user = CRUDUser()
 
     logging.info(f"Updating sex for user {user_id} to {new_sex}")
-    await crud_user.update(session, user_id, sex=new_sex)
+    await crud_user.update_returning(session, {'telegram_id': user_id}, sex=new_sex)
 
     await message.answer(f"Пол успешно обновлен на {new_sex}!", reply_markup=main_menu_keyboard())
     await state.clear()
@@ -217,13 +220,11 @@ async def process_field_choice(message: types.Message, state: FSMContext, sessio
 
     if field in ["профиль", "изменить профиль", "найти фильм"]:
         await state.update_data(field=field)
-        user = await crud_user.get_username_by_telegram_id(session, user_id)
-        user_age = await crud_user.get_age_by_telegram_id(session, user_id)
-        user_sex = await crud_user.get_sex_by_telegram_id(session, user_id)
         if field == "профиль":
-            await message.answer(f"Имя: {user}\n"
-                                 f"Возраст: {user_age}\n"
-                                 f"Пол: {user_sex}")
+            profile = await crud_user.get_profile(session, user_id) or {}
+            await message.answer(f"Имя: {profile.get('first_name')}\n"
+                                 f"Возраст: {profile.get('age')}\n"
+                                 f"Пол: {profile.get('sex')}")
             await state.update_data(field=field)
             return
         elif field == "изменить профиль":
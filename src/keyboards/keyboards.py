@@ -48,6 +48,7 @@ def admin_panel() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="📩 Рассылка", callback_data="admin_mailing")],
+        [InlineKeyboardButton(text="📋 Активные рассылки", callback_data="admin_mailing_jobs")],
         [InlineKeyboardButton(text="Главное меню", callback_data="back_to_menu")]
     ])
 
@@ -58,6 +59,17 @@ def confirm_kb():
         [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_back")]
     ])
 
+def mailing_job_kb(job_id: int, status: str) -> InlineKeyboardMarkup:
+    """Управление заданием рассылки"""
+    if status == 'running':
+        toggle = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"mailing_pause_{job_id}")
+    else:
+        toggle = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"mailing_resume_{job_id}")
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text="⏹ Отменить", callback_data=f"mailing_cancel_{job_id}")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+    ])
+
 def cancel_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_back")]
@@ -69,9 +81,20 @@ def movie_menu():
         [InlineKeyboardButton(text="Поиск фильма по названию", callback_data="find_movie")],
         [InlineKeyboardButton(text="Рандомный фильм", callback_data="random_movie")],
         [InlineKeyboardButton(text="Рандомный фильм по жанру", callback_data="random_movie_genre")],
+        [InlineKeyboardButton(text="Рекомендации для вас", callback_data="recommendations")],
+        [InlineKeyboardButton(text="Избранное", callback_data="favorites")],
     ])
 
 
+def film_actions_kb(film_id: str, is_favorite: bool = False) -> InlineKeyboardMarkup:
+    """Кнопки под карточкой фильма"""
+    if is_favorite:
+        button = InlineKeyboardButton(text="❌ Убрать из избранного", callback_data=f"fav_del_{film_id}")
+    else:
+        button = InlineKeyboardButton(text="⭐ В избранное", callback_data=f"fav_add_{film_id}")
+    return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+
 def genre_menu():
     return InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Комедия", callback_data="comedy_btn")],
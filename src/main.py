@@ -1,58 +1,389 @@
+import os
 import logging
 import asyncio
+import multiprocessing
+import signal
 from os import getenv
+from queue import Full
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.handlers import start, search, admin
+from src.database.engine import engine, async_session_maker, LazySession
+from src.handlers import start, search, admin, favorites, inline
+from src.utils.kinopoisk import kinopoisk
+from src.utils.activity import activity
+from src.utils.fsm_storage import PostgresStorage, TTLMemoryStorage
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Инициализация бота и хранилища
-storage = MemoryStorage()
+# Инициализация бота и хранилища.
+# FSM_STORAGE=postgres - общее хранилище состояний для нескольких процессов/реплик,
+# memory - в памяти процесса с удалением брошенных состояний
+FSM_STATE_TTL = float(getenv("FSM_STATE_TTL", str(24 * 3600)))
+if getenv("FSM_STORAGE", "memory") == "postgres":
+    storage = PostgresStorage(async_session_maker, ttl=FSM_STATE_TTL)
+else:
+    storage = TTLMemoryStorage(idle_ttl=FSM_STATE_TTL)
 bot = Bot(token=getenv('BOT_TOKEN'))
 
-# Инициализация асинхронного движка и сессии
-engine = create_async_engine(getenv("PG_URL"), echo=True)
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
-
 async def get_session() -> AsyncSession:
     """
     Возвращает асинхронную сессию для DI.
     """
-    async with async_session() as session:
+    async with async_session_maker() as session:
         yield session
 
 
-async def main():
-    # Инициализация диспетчера
+# Режим получения апдейтов: polling (по умолчанию), webhook или sharded
+BOT_MODE = getenv("BOT_MODE", "polling")
+WEBHOOK_URL = getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(getenv("WEBAPP_PORT", "8080"))
+# Сколько одновременных соединений Telegram открывает к webhook и сколько
+# подтвержденных, но еще не обработанных апдейтов может ждать в процессе
+WEBHOOK_MAX_CONNECTIONS = int(getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_PENDING = int(getenv("WEBHOOK_MAX_PENDING", "1000"))
+# Сколько апдейтов обрабатывается одновременно
+MAX_CONCURRENT_UPDATES = int(getenv("MAX_CONCURRENT_UPDATES", "100"))
+# BOT_MODE=sharded: число процессов-воркеров и размер очереди каждого.
+# Пул соединений с БД (DB_POOL_SIZE + DB_MAX_OVERFLOW) делится между воркерами,
+# но каждому достается не меньше 3 соединений (см. src.database.engine)
+BOT_WORKERS = int(getenv("BOT_WORKERS", str(min(os.cpu_count() or 1, 4))))
+WORKER_QUEUE_SIZE = int(getenv("WORKER_QUEUE_SIZE", "1000"))
+# Сколько ждать, пока воркер доработает очередь при остановке, прежде чем завершить его
+WORKER_SHUTDOWN_TIMEOUT = float(getenv("WORKER_SHUTDOWN_TIMEOUT", "30"))
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отмечает активность пользователя (запись в БД - пачками в фоне)"""
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user:
+            activity.touch(user.id)
+        return await handler(event, data)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых апдейтов"""
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Подтверждает апдейт и обрабатывает его в фоне, но не больше max_pending
+    апдейтов одновременно: когда слотов нет, ответ Telegram задерживается,
+    и он сам снижает скорость доставки.
+    """
+
+    def __init__(self, *args, max_pending: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()
+        try:
+            return await super()._handle_request_background(bot, request)
+        except Exception:
+            self._slots.release()
+            raise
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        try:
+            await super()._background_feed_update(bot, update)
+        finally:
+            self._slots.release()
+
+
+def stop_event() -> asyncio.Event:
+    """
+    Событие, которое выставляется по SIGTERM/SIGINT (docker stop, Kubernetes),
+    чтобы бот успел выполнить shutdown-хуки и сохранить буферы.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+def check_webhook_config():
+    """
+    Без секрета webhook принимает апдейты от кого угодно, без URL не будет зарегистрирован.
+    """
+    missing = [name for name, value in (("WEBHOOK_URL", WEBHOOK_URL), ("WEBHOOK_SECRET", WEBHOOK_SECRET))
+               if not value]
+    if missing:
+        raise RuntimeError(f"BOT_MODE=webhook требует переменных окружения: {', '.join(missing)}")
+
+
+async def run_webhook(dp: Dispatcher):
+    """
+    Принимает апдейты через aiohttp-сервер. Запрос подтверждается сразу,
+    а апдейт обрабатывается в фоне.
+    """
+    app = web.Application()
+    BoundedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True,
+        max_pending=WEBHOOK_MAX_PENDING
+    ).register(app, path=WEBHOOK_PATH)
+    # Связывает startup/shutdown диспетчера с жизненным циклом приложения
+    setup_application(app, dp, bot=bot)
+
+    async def set_webhook(bot: Bot):
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+
+    dp.startup.register(set_webhook)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT).start()
+        logger.info(f"Webhook слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+        await stop_event().wait()
+        logger.info("Получен сигнал остановки, завершаем работу")
+    finally:
+        await runner.cleanup()
+
+
+def build_dispatcher(resume_mailings: bool = True) -> Dispatcher:
+    """
+    Создает диспетчер с роутерами, middleware и хуками запуска/остановки.
+    """
     dp = Dispatcher(storage=storage)
 
     # Регистрация роутеров
-    dp.include_routers(admin.admin_router, start.router, search.router,)
+    dp.include_routers(admin.admin_router, start.router, search.router, favorites.router, inline.router)
 
 
     class DBSessionMiddleware(BaseMiddleware):
         async def __call__(self, handler, event, data):
-            async with async_session() as session:
-                data["session"] = session
+            # Соединение берется из пула только если хендлер обратится к сессии
+            session = LazySession(async_session_maker)
+            data["session"] = session
+            try:
                 return await handler(event, data)
+            finally:
+                await session.close()
 
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES))
+    dp.update.outer_middleware(ActivityMiddleware())
     dp.update.middleware(DBSessionMiddleware())
 
+    # Заполняем пулы случайных фильмов в фоне и продолжаем прерванные рассылки
+    dp.startup.register(search.random_pool.warm_up)
+    dp.startup.register(activity.start)
+    if resume_mailings:
+        dp.startup.register(admin.mailing_runner.resume_unfinished)
 
-    # Запуск бота
-    logger.info("Бот запущен")
+    # Останавливаем фоновые задачи и закрываем пулы соединений (Kinopoisk и БД)
+    dp.shutdown.register(search.random_pool.close)
+    dp.shutdown.register(admin.mailing_runner.shutdown)
+    dp.shutdown.register(kinopoisk.close)
+    dp.shutdown.register(storage.close)
+    dp.shutdown.register(activity.close)
+    dp.shutdown.register(engine.dispose)
+    return dp
+
+
+async def notify_admins():
     for every in admin.admins:
         await bot.send_message(chat_id=every, text="Бот запущен, админ панель /admin")
-    await dp.start_polling(bot)
+
+
+# --- Режим sharded: supervisor + N процессов-воркеров ---
+
+def shard_key(update: dict) -> int:
+    """
+    Ключ шардирования апдейта: id пользователя (или чата), иначе update_id.
+    Все апдейты одного пользователя попадают в один воркер.
+    """
+    for name, body in update.items():
+        if name == "update_id" or not isinstance(body, dict):
+            continue
+        user = body.get("from") or body.get("user")
+        if user:
+            return user["id"]
+        chat = body.get("chat") or (body.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return update["update_id"]
+
+
+async def run_worker(index: int, queue):
+    """
+    Обрабатывает апдейты из очереди supervisor'а. Апдейты одного пользователя
+    выполняются строго по порядку, разных пользователей - параллельно.
+    Inline-запросы не используют FSM и в очередь пользователя не встают.
+    """
+    dp = build_dispatcher(resume_mailings=index == 0)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    loop = asyncio.get_running_loop()
+    user_tasks = {}
+    inline_tasks = set()
+
+    async def process(update: dict, previous):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error(f"Worker {index}: update {update.get('update_id')} failed: {e}", exc_info=True)
+
+    def forget(key, task):
+        if user_tasks.get(key) is task:
+            del user_tasks[key]
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            key, update = item
+            if "inline_query" in update:
+                # Иначе новый запрос ждал бы устаревший, и его debounce не мог бы отменить
+                task = asyncio.create_task(process(update, None))
+                inline_tasks.add(task)
+                task.add_done_callback(inline_tasks.discard)
+                continue
+            task = asyncio.create_task(process(update, user_tasks.get(key)))
+            user_tasks[key] = task
+            task.add_done_callback(lambda t, k=key: forget(k, t))
+    finally:
+        await asyncio.gather(*user_tasks.values(), *inline_tasks, return_exceptions=True)
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
+
+def _worker_entry(index: int, queue):
+    # Остановкой воркеров управляет supervisor (через None в очереди),
+    # сигнал, пришедший всей группе процессов, не должен прерывать обработку
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        asyncio.run(run_worker(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+
+async def supervise(queues):
+    """
+    Получает апдейты через getUpdates и раздает их воркерам по shard_key.
+    """
+    # Диспетчер здесь нужен только чтобы узнать, какие типы апдейтов обрабатываются
+    allowed_updates = build_dispatcher(resume_mailings=False).resolve_used_update_types()
+    loop = asyncio.get_running_loop()
+    await bot.delete_webhook()
+    logger.info(f"Бот запущен, воркеров: {len(queues)}")
+    await notify_admins()
+    stop = stop_event()
+
+    async def deliver(queue, item) -> bool:
+        # Блокирующий put дает обратное давление, если воркер не успевает;
+        # таймаут - чтобы остановка не зависла на переполненной очереди
+        while not stop.is_set():
+            try:
+                await loop.run_in_executor(None, lambda: queue.put(item, timeout=1))
+                return True
+            except Full:
+                continue
+        return False
+
+    offset = None
+    try:
+        while not stop.is_set():
+            poll = asyncio.create_task(
+                bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            )
+            stopping = asyncio.create_task(stop.wait())
+            await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except Exception as e:
+                logger.error(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                raw = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+                key = shard_key(raw)
+                if not await deliver(queues[key % len(queues)], (key, raw)):
+                    break
+                # Недоставленные воркерам апдейты Telegram отдаст снова при следующем запуске
+                offset = update.update_id + 1
+        logger.info("Получен сигнал остановки, завершаем воркеры")
+    finally:
+        await bot.session.close()
+
+
+def run_sharded(workers: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+    processes = [
+        ctx.Process(target=_worker_entry, args=(index, queue), name=f"bot-worker-{index}")
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(supervise(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for index, queue in enumerate(queues):
+            try:
+                queue.put(None, timeout=WORKER_SHUTDOWN_TIMEOUT)
+            except Full:
+                logger.warning(f"Воркер {index} не разбирает очередь")
+        for process in processes:
+            process.join(timeout=WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"{process.name} не завершился за {WORKER_SHUTDOWN_TIMEOUT} с, останавливаем")
+                process.terminate()
+                process.join()
+
+
+async def main():
+    if BOT_MODE == "webhook":
+        check_webhook_config()
+    dp = build_dispatcher()
+
+    # Запуск бота
+    logger.info("Бот запущен")
+    await notify_admins()
+    if BOT_MODE == "webhook":
+        await run_webhook(dp)
+    else:
+        # Webhook, оставшийся от запуска в другом режиме, блокирует getUpdates
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if BOT_MODE == "sharded":
+        run_sharded(BOT_WORKERS)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from os import getenv
+from typing import List, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from src.database.crud import CRUDSearchHistory, CRUDUser
+from src.database.engine import async_session_maker
+
+
+class ActivityWriter:
+    """
+    Отложенная запись аналитики: история поиска и время последней активности
+    копятся в памяти и сохраняются пачками по размеру или по таймеру,
+    не добавляя коммит к каждому запросу пользователя.
+    """
+
+    def __init__(self, session_maker: async_sessionmaker, flush_interval: float = 5.0, max_batch: int = 500):
+        self.session_maker = session_maker
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._searches: List[Tuple[int, str]] = []
+        self._seen: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._lock = asyncio.Lock()
+        self.crud_user = CRUDUser()
+        self.crud_history = CRUDSearchHistory()
+
+    def _queued(self) -> int:
+        return len(self._searches) + len(self._seen)
+
+    def record_search(self, telegram_id: int, query: str):
+        self._searches.append((telegram_id, query))
+        self.touch(telegram_id)
+
+    def touch(self, telegram_id: int):
+        self._seen.add(telegram_id)
+        if self._queued() >= self.max_batch:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Activity flush failed: {e}")
+
+    async def flush(self):
+        """
+        Сохраняет накопленное одной транзакцией. При ошибке данные возвращаются в буфер.
+        """
+        async with self._lock:
+            searches, self._searches = self._searches, []
+            seen, self._seen = self._seen, set()
+            if not searches and not seen:
+                return
+            try:
+                async with self.session_maker() as session:
+                    # Один коммит: при ошибке ничего не записано и повтор не создаст дублей
+                    await self.crud_history.bulk_record(session, searches, commit=False)
+                    await self.crud_user.touch_many(session, list(seen), commit=False)
+                    await session.commit()
+            except BaseException:
+                # В том числе при отмене: пачка уже вынута из буфера
+                self._searches[:0] = searches
+                self._seen |= seen
+                raise
+
+    async def close(self):
+        """
+        Останавливает фоновую запись и сохраняет остаток буфера.
+        Идущий сброс не отменяется, а дожидается завершения.
+        """
+        if self._task:
+            self._closing = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+activity = ActivityWriter(
+    async_session_maker,
+    flush_interval=float(getenv("ACTIVITY_FLUSH_INTERVAL", "5")),
+    max_batch=int(getenv("ACTIVITY_MAX_BATCH", "500"))
+)
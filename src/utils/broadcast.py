@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from os import getenv
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+
+class TokenBucket:
+    """
+    Глобальный ограничитель скорости отправки (token bucket).
+
+    pause() останавливает выдачу токенов для всех отправителей сразу —
+    так бот реагирует на TelegramRetryAfter, не продолжая бить в лимит из других корутин.
+    """
+
+    def __init__(self, rate: float = 28, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Ждет свободный токен (и окончания паузы, если она объявлена).
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Приостанавливает выдачу токенов на seconds секунд.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Токены начинают копиться только после паузы, иначе сразу после нее уйдет всплеск
+        self._tokens = 0
+        self._updated = self._paused_until
+
+
+@dataclass
+class BroadcastStats:
+    total: int = 0
+    success: int = 0
+    failed: int = 0
+    blocked: List[int] = field(default_factory=list)
+
+    @property
+    def processed(self) -> int:
+        return self.success + self.failed
+
+
+class Broadcaster:
+    """
+    Рассылка сообщений пулом воркеров под общим token bucket.
+    """
+
+    def __init__(self, bot: Bot, bucket: TokenBucket, workers: int = 20, max_retries: int = 3):
+        self.bot = bot
+        self.bucket = bucket
+        self.workers = workers
+        self.max_retries = max_retries
+
+    async def _send(self, chat_id: int, text: str, parse_mode: str, stats: BroadcastStats) -> str:
+        """
+        Отправляет одно сообщение. Возвращает 'sent', 'blocked' или 'failed'.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                stats.success += 1
+                return 'sent'
+            except TelegramRetryAfter as e:
+                # Лимит превышен - останавливаем всю рассылку, а не одну корутину
+                logging.warning(f"Flood control, pausing broadcast for {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота или удалил аккаунт
+                stats.failed += 1
+                stats.blocked.append(chat_id)
+                return 'blocked'
+            except Exception as e:
+                logging.error(f"Ошибка при отправке пользователю {chat_id}: {e}")
+                stats.failed += 1
+                return 'failed'
+        stats.failed += 1
+        return 'failed'
+
+    async def run(
+        self,
+        chat_ids: Iterable[int],
+        text: str,
+        parse_mode: str = "HTML",
+        on_progress: Optional[Callable[[BroadcastStats], Awaitable[None]]] = None,
+        progress_interval: float = 3.0,
+        on_result: Optional[Callable[[int, str], None]] = None,
+        stop: Optional[asyncio.Event] = None,
+    ) -> BroadcastStats:
+        """
+        Отправляет text всем chat_ids. on_progress вызывается по таймеру, а не на каждое сообщение.
+        on_result(chat_id, status) получает итог по каждому получателю; после установки stop
+        воркеры не берут новых получателей.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+        stats = BroadcastStats(total=queue.qsize())
+
+        async def worker():
+            while stop is None or not stop.is_set():
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                status = await self._send(chat_id, text, parse_mode, stats)
+                if on_result:
+                    on_result(chat_id, status)
+
+        async def report():
+            while True:
+                await asyncio.sleep(progress_interval)
+                try:
+                    await on_progress(stats)
+                except Exception as e:
+                    logging.debug(f"Progress update failed: {e}")
+
+        reporter = asyncio.create_task(report()) if on_progress else None
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.workers, stats.total) or 1)))
+        finally:
+            if reporter:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+        return stats
+
+
+# Общий лимит Telegram ~30 сообщений в секунду на бота
+telegram_bucket = TokenBucket(rate=float(getenv("BROADCAST_RATE", "28")))
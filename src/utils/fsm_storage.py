@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from src.database.models import FSMRecord
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states, общее для всех процессов и реплик бота.
+
+    Чтения, пришедшие за один проход event loop, объединяются в один SELECT,
+    записи копятся и сохраняются одним INSERT ... ON CONFLICT. Каждая запись
+    продлевает срок жизни ключа на ttl; просроченные ключи не читаются и
+    периодически удаляются. Неудавшееся сохранение повторяется с нарастающей паузой.
+
+    set_state/set_data возвращаются до коммита: этот процесс сразу видит новое
+    состояние, а другие реплики - только после сохранения. Без привязки
+    пользователя к реплике (sticky) соседний апдейт может прочитать предыдущее состояние.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        ttl: float = 7 * 24 * 3600,
+        cleanup_interval: float = 3600,
+        key_builder: Optional[KeyBuilder] = None,
+        max_retry_delay: float = 60,
+    ):
+        self.session_maker = session_maker
+        self.ttl = timedelta(seconds=ttl)
+        self.cleanup_interval = cleanup_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        # Ожидающие записи: key -> {'state': ..., 'data': ...}
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        # Записи, которые сохраняются прямо сейчас (видны чтениям до коммита)
+        self._flushing: Dict[str, Dict[str, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.max_retry_delay = max_retry_delay
+        self._retry_delay = 0.0
+        self._read_waiters: Dict[str, asyncio.Future] = {}
+        self._read_task: Optional[asyncio.Task] = None
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    def _start_cleanup(self):
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    # --- чтение ---
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        self._start_cleanup()
+        future = self._read_waiters.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._read_waiters[key] = future
+            if self._read_task is None:
+                self._read_task = asyncio.create_task(self._read_batch())
+        return await asyncio.shield(future)
+
+    async def _read_batch(self):
+        # Даем остальным корутинам текущего прохода loop добавить свои ключи
+        await asyncio.sleep(0)
+        waiters, self._read_waiters = self._read_waiters, {}
+        self._read_task = None
+        try:
+            async with self.session_maker() as session:
+                result = await session.execute(
+                    select(FSMRecord.key, FSMRecord.state, FSMRecord.data).where(
+                        FSMRecord.key.in_(list(waiters)),
+                        FSMRecord.expires_at > func.now(),
+                    )
+                )
+                rows = {key: (state, data or {}) for key, state, data in result.all()}
+        except Exception as e:
+            for future in waiters.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in waiters.items():
+            if not future.done():
+                future.set_result(rows.get(key, (None, {})))
+
+    async def _get_field(self, key: StorageKey, field: str):
+        storage_key = self.key_builder.build(key)
+        for writes in (self._pending, self._flushing):
+            fields = writes.get(storage_key, {})
+            if field in fields:
+                return fields[field]
+        state, data = await self._load(storage_key)
+        return state if field == 'state' else data
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._get_field(key, 'state')
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(await self._get_field(key, 'data'))
+
+    # --- запись ---
+
+    def _write(self, key: StorageKey, **fields):
+        self._start_cleanup()
+        self._pending.setdefault(self.key_builder.build(key), {}).update(fields)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._write(key, data=dict(data))
+
+    async def _flush_soon(self, delay: float = 0):
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        try:
+            await self.flush()
+            self._retry_delay = 0.0
+        except Exception as e:
+            # Записи вернулись в _pending - повторяем сами, не дожидаясь новой записи
+            self._retry_delay = min(max(self._retry_delay * 2, 1.0), self.max_retry_delay)
+            logging.error(f"FSM storage flush failed, retry in {self._retry_delay:.0f}s: {e}")
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_soon(self._retry_delay))
+
+    async def flush(self):
+        """
+        Сохраняет накопленные изменения. Записи с одинаковым набором полей
+        уходят одним INSERT ... ON CONFLICT.
+        """
+        # Последовательные сбросы: более свежая запись не обгонит предыдущую
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        self._flushing = pending
+        groups: Dict[Tuple[str, ...], list] = {}
+        for key, fields in pending.items():
+            groups.setdefault(tuple(sorted(fields)), []).append({'key': key, **fields})
+
+        expires_at = func.now() + self.ttl
+        try:
+            async with self.session_maker() as session:
+                for columns, rows in groups.items():
+                    # state=None и пустые data - ключ можно просто удалить
+                    if columns == ('data', 'state'):
+                        empty = [row['key'] for row in rows if row['state'] is None and not row['data']]
+                        if empty:
+                            await session.execute(delete(FSMRecord).where(FSMRecord.key.in_(empty)))
+                            rows = [row for row in rows if row['key'] not in empty]
+                        if not rows:
+                            continue
+                    stmt = insert(FSMRecord).values([{**row, 'expires_at': expires_at} for row in rows])
+                    set_ = {column: stmt.excluded[column] for column in columns}
+                    set_['expires_at'] = stmt.excluded.expires_at
+                    await session.execute(stmt.on_conflict_do_update(index_elements=[FSMRecord.key], set_=set_))
+                await session.commit()
+        except Exception:
+            # Возвращаем несохраненное, не затирая более свежие изменения
+            for key, fields in pending.items():
+                self._pending[key] = {**fields, **self._pending.get(key, {})}
+            raise
+        finally:
+            self._flushing = {}
+
+    # --- очистка ---
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                async with self.session_maker() as session:
+                    result = await session.execute(delete(FSMRecord).where(FSMRecord.expires_at <= func.now()))
+                    await session.commit()
+                logging.info(f"FSM storage: removed {result.rowcount} expired states")
+            except Exception as e:
+                logging.error(f"FSM storage cleanup failed: {e}")
+
+    async def close(self) -> None:
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+
+@dataclass
+class _MemoryRecord:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    touched: float = field(default_factory=time.monotonic)
+
+
+class TTLMemoryStorage(BaseStorage):
+    """
+    Хранилище FSM в памяти процесса с вытеснением неактивных ключей.
+
+    Ключ, к которому не обращались дольше idle_ttl секунд (брошенная регистрация,
+    поиск, черновик рассылки), считается отсутствующим и удаляется фоновой очисткой.
+    """
+
+    def __init__(self, idle_ttl: float = 24 * 3600, sweep_interval: float = 600):
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.evicted = 0
+        self._records: Dict[StorageKey, _MemoryRecord] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def _start_sweeper(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    def _expired(self, record: _MemoryRecord, now: float) -> bool:
+        return now - record.touched > self.idle_ttl
+
+    def _get(self, key: StorageKey) -> Optional[_MemoryRecord]:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        now = time.monotonic()
+        if self._expired(record, now):
+            del self._records[key]
+            self.evicted += 1
+            return None
+        record.touched = now
+        return record
+
+    def _get_or_create(self, key: StorageKey) -> _MemoryRecord:
+        self._start_sweeper()
+        record = self._get(key)
+        if record is None:
+            record = self._records[key] = _MemoryRecord()
+        return record
+
+    def _drop_if_empty(self, key: StorageKey, record: _MemoryRecord):
+        if record.state is None and not record.data:
+            self._records.pop(key, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get_or_create(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._drop_if_empty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = self._get_or_create(key)
+        record.data = dict(data)
+        self._drop_if_empty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return dict(record.data) if record else {}
+
+    def sweep(self) -> int:
+        """
+        Удаляет все просроченные ключи, возвращает их количество.
+        """
+        now = time.monotonic()
+        expired = [key for key, record in self._records.items() if self._expired(record, now)]
+        for key in expired:
+            del self._records[key]
+        self.evicted += len(expired)
+        return len(expired)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            removed = self.sweep()
+            if removed:
+                logging.info(f"FSM storage: evicted {removed} idle states, {len(self._records)} live")
+
+    def stats(self) -> Dict[str, int]:
+        return {"live": len(self._records), "evicted": self.evicted}
+
+    async def close(self) -> None:
+        if self._sweeper:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
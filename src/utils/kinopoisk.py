@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+
+KINOPOISK_API_URL = "https://api.kinopoisk.dev/v1.4"
+
+
+def _encode_params(params: Optional[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    """
+    Приводит параметры к виду, который понимает aiohttp:
+    списки разворачиваются в повторяющиеся ключи (как это делал requests).
+    """
+    encoded = []
+    for key, value in (params or {}).items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for item in values:
+            if isinstance(item, bool):
+                item = "true" if item else "false"
+            encoded.append((key, str(item)))
+    return encoded
+
+
+class KinopoiskClient:
+    """
+    Асинхронный клиент Kinopoisk API.
+
+    Держит одну долгоживущую aiohttp-сессию с пулом keep-alive соединений
+    и ограничивает число одновременных запросов, чтобы медленный ответ API
+    не блокировал event loop бота.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: str = KINOPOISK_API_URL,
+        timeout: float = 10,
+        max_concurrency: int = 10,
+        pool_size: int = 20,
+        keepalive_timeout: float = 30,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Лениво создает сессию (внутри запущенного event loop).
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"X-API-KEY": self.api_key or ""},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def get(self, path: str, params: Optional[Dict[str, Any]] = None,
+                  timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Выполняет GET-запрос к API и возвращает разобранный JSON.
+        При ответе с ошибкой выбрасывает aiohttp.ClientResponseError.
+        """
+        session = self._get_session()
+        kwargs = {}
+        # timeout=None отключил бы таймаут совсем - без него действует таймаут сессии
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        async with self._semaphore:
+            async with session.get(
+                f"{self.base_url}{path}",
+                params=_encode_params(params),
+                **kwargs,
+            ) as response:
+                logging.debug(f"Kinopoisk {response.status}: {response.url}")
+                if response.status >= 400:
+                    body = await response.text()
+                    logging.error(f"Kinopoisk API error {response.status}: {body[:500]}")
+                response.raise_for_status()
+                return await response.json()
+
+    async def close(self):
+        """
+        Закрывает сессию и пул соединений.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# Общий клиент на весь процесс
+kinopoisk = KinopoiskClient(
+    api_key=getenv("KNP_API"),
+    max_concurrency=int(getenv("KNP_MAX_CONCURRENCY", "10")),
+    pool_size=int(getenv("KNP_POOL_SIZE", "20")),
+)
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from src.database.crud import CRUDMailingJob
+from src.keyboards.keyboards import mailing_job_kb
+from src.utils.broadcast import Broadcaster, BroadcastStats, TokenBucket
+
+
+def mailing_progress_text(job_id: int, total: int, processed: int, success: int, failed: int,
+                          paused: bool = False) -> str:
+    progress = min(processed / total * 100, 100) if total else 100
+    title = "⏸ Рассылка на паузе" if paused else "⏳ Рассылка в процессе..."
+    return (
+        f"{title} (#{job_id})\n\n"
+        f"▰{'▰' * int(progress // 10)}{'▱' * (10 - int(progress // 10))}\n"
+        f"📊 {processed}/{total} ({progress:.1f}%)\n"
+        f"✅ {success} | ❌ {failed}"
+    )
+
+
+def mailing_cancelled_text(job_id: int, total: int, success: int, failed: int) -> str:
+    return f"⏹ Рассылка #{job_id} отменена\n\n✅ {success} | ❌ {failed} из {total}"
+
+
+class MailingRunner:
+    """
+    Выполняет задания рассылки из таблицы mailing_jobs.
+
+    Результаты по получателям периодически сохраняются (checkpoint), поэтому после
+    перезапуска бота задание продолжается только для тех, кому сообщение еще не ушло.
+
+    Перед отправкой задание арендуется (owner + heartbeat_at), и каждый checkpoint
+    продлевает аренду. Поэтому при нескольких репликах или rolling restart задание
+    выполняет ровно один процесс. Задание упавшего процесса подхватывается после
+    lease_timeout секунд без checkpoint.
+    """
+
+    def __init__(self, session_maker: async_sessionmaker, bucket: TokenBucket, workers: int = 20,
+                 checkpoint_interval: float = 1.0, progress_interval: float = 3.0,
+                 lease_timeout: float = 60.0):
+        self.session_maker = session_maker
+        self.bucket = bucket
+        self.workers = workers
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_interval = progress_interval
+        self.lease_timeout = lease_timeout
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.crud = CRUDMailingJob()
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._stops: Dict[int, asyncio.Event] = {}
+        self._watcher: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def is_running(self, job_id: int) -> bool:
+        task = self._tasks.get(job_id)
+        return task is not None and not task.done()
+
+    def start(self, bot: Bot, job_id: int):
+        """
+        Запускает задание в фоне (если оно еще не выполняется).
+        """
+        if self._closing:
+            return
+        if self.is_running(job_id):
+            if self._stops[job_id].is_set():
+                # Предыдущий запуск еще останавливается (пауза) - перезапустим после него
+                self._tasks[job_id].add_done_callback(lambda _: self.start(bot, job_id))
+            return
+        self._stops[job_id] = asyncio.Event()
+        self._tasks[job_id] = asyncio.create_task(self._run(bot, job_id))
+
+    async def create(self, text: str, created_by: int, chat_id: int, message_id: int) -> int:
+        """
+        Сохраняет задание и список получателей; запуск - через start().
+        """
+        async with self.session_maker() as session:
+            job = await self.crud.create_job(session, text, created_by, chat_id, message_id)
+        return job.id
+
+    async def resume_unfinished(self, bot: Bot):
+        """
+        Продолжает задания, прерванные остановкой бота, и дальше периодически
+        подхватывает задания, оставшиеся без владельца.
+        """
+        await self._resume(bot)
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch(bot))
+
+    async def _resume(self, bot: Bot):
+        async with self.session_maker() as session:
+            jobs = await self.crud.get_by_status(session, 'running')
+        for job in jobs:
+            if not self.is_running(job.id):
+                logging.info(f"Resuming mailing job #{job.id}")
+                self.start(bot, job.id)
+
+    async def _watch(self, bot: Bot):
+        while True:
+            await asyncio.sleep(self.lease_timeout / 2)
+            try:
+                await self._resume(bot)
+            except Exception as e:
+                logging.error(f"Mailing watcher failed: {e}")
+
+    def _signal_stop(self, job_id: int):
+        """
+        Просит задание остановиться, не дожидаясь этого: во время паузы после
+        TelegramRetryAfter воркеры могут освободиться только через десятки секунд.
+        Итог остановки задание само показывает в сообщении прогресса.
+        """
+        stop = self._stops.get(job_id)
+        if stop:
+            stop.set()
+
+    async def _stop(self, job_id: int):
+        self._signal_stop(job_id)
+        task = self._tasks.get(job_id)
+        if task and not task.done():
+            await task
+
+    async def pause(self, job_id: int) -> bool:
+        async with self.session_maker() as session:
+            changed = await self.crud.set_status(session, job_id, 'paused', only_from=('running',))
+        self._signal_stop(job_id)
+        return changed
+
+    async def resume(self, bot: Bot, job_id: int) -> bool:
+        async with self.session_maker() as session:
+            changed = await self.crud.set_status(session, job_id, 'running', only_from=('paused',))
+        if changed:
+            self.start(bot, job_id)
+        return changed
+
+    async def cancel(self, job_id: int) -> bool:
+        async with self.session_maker() as session:
+            changed = await self.crud.set_status(session, job_id, 'cancelled', only_from=('running', 'paused'))
+        self._signal_stop(job_id)
+        return changed
+
+    async def shutdown(self):
+        """
+        Останавливает выполнение при выключении бота; статус 'running' сохраняется
+        для возобновления при следующем старте.
+        """
+        self._closing = True
+        if self._watcher:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        await asyncio.gather(*(self._stop(job_id) for job_id in list(self._tasks)), return_exceptions=True)
+
+    async def _run(self, bot: Bot, job_id: int):
+        async with self.session_maker() as session:
+            # Задание уже выполняет другой процесс (или оно не в статусе running)
+            if not await self.crud.claim(session, job_id, self.owner, self.lease_timeout):
+                logging.info(f"Mailing job #{job_id} is not available, skipping")
+                return
+        try:
+            await self._send_job(bot, job_id)
+        finally:
+            try:
+                async with self.session_maker() as session:
+                    await self.crud.release(session, job_id, self.owner)
+            except Exception as e:
+                logging.error(f"Mailing #{job_id} release failed: {e}")
+
+    async def _send_job(self, bot: Bot, job_id: int):
+        async with self.session_maker() as session:
+            job = await self.crud.get(session, job_id)
+            pending = await self.crud.get_pending_recipients(session, job_id)
+
+        stop = self._stops[job_id]
+        sent: List[int] = []
+        failed: List[int] = []
+        blocked: List[int] = []
+        base_success, base_failed = job.success, job.failed
+        last_status = job.status
+
+        def record(chat_id: int, status: str):
+            if status == 'sent':
+                sent.append(chat_id)
+            else:
+                failed.append(chat_id)
+                if status == 'blocked':
+                    blocked.append(chat_id)
+
+        async def flush():
+            nonlocal last_status
+            # Вызывается и без новых результатов: checkpoint продлевает аренду
+            batch_sent, batch_failed, batch_blocked = sent[:], failed[:], blocked[:]
+            del sent[:], failed[:], blocked[:]
+            try:
+                async with self.session_maker() as session:
+                    status, owner = await self.crud.checkpoint(
+                        session, job_id, batch_sent, batch_failed, batch_blocked, owner=self.owner
+                    )
+            except Exception:
+                # Не теряем результаты: попробуем сохранить их при следующем checkpoint
+                sent[:0], failed[:0], blocked[:0] = batch_sent, batch_failed, batch_blocked
+                raise
+            last_status = status if owner == self.owner else None
+            # Задание могли поставить на паузу или отменить из другого процесса,
+            # либо аренду забрал другой процесс (мы долго не делали checkpoint)
+            if status != 'running' or owner != self.owner:
+                stop.set()
+
+        async def checkpoints():
+            while True:
+                await asyncio.sleep(self.checkpoint_interval)
+                try:
+                    await flush()
+                except Exception as e:
+                    logging.error(f"Mailing #{job_id} checkpoint failed: {e}")
+
+        async def update_progress(stats: BroadcastStats):
+            # После остановки сообщение обновит итог остановки, а не "в процессе"
+            if stop.is_set():
+                return
+            await bot.edit_message_text(
+                mailing_progress_text(
+                    job_id, job.total, base_success + base_failed + stats.processed,
+                    base_success + stats.success, base_failed + stats.failed
+                ),
+                chat_id=job.progress_chat_id,
+                message_id=job.progress_message_id,
+                reply_markup=mailing_job_kb(job_id, 'running')
+            )
+
+        broadcaster = Broadcaster(bot, self.bucket, workers=self.workers)
+        checkpointer = asyncio.create_task(checkpoints())
+        try:
+            stats = await broadcaster.run(
+                pending,
+                job.text,
+                on_progress=update_progress if job.progress_message_id else None,
+                progress_interval=self.progress_interval,
+                on_result=record,
+                stop=stop
+            )
+        finally:
+            checkpointer.cancel()
+            await asyncio.gather(checkpointer, return_exceptions=True)
+            await flush()
+
+        if stop.is_set():
+            if job.progress_message_id and last_status in ('paused', 'cancelled'):
+                await self._report_stopped(
+                    bot, job, last_status, base_success + stats.success, base_failed + stats.failed
+                )
+            return
+
+        async with self.session_maker() as session:
+            await self.crud.set_status(session, job_id, 'done')
+
+        if job.progress_message_id:
+            report = (
+                f"📊 <b>Отчет о рассылке</b>\n\n"
+                f"▪️ Всего пользователей: {job.total}\n"
+                f"✅ Успешно отправлено: {base_success + stats.success}\n"
+                f"❌ Не удалось отправить: {base_failed + stats.failed}\n\n"
+                f"<i>Последняя рассылка завершена</i>"
+            )
+            try:
+                await bot.edit_message_text(
+                    report,
+                    chat_id=job.progress_chat_id,
+                    message_id=job.progress_message_id,
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="🔙 В админ-панель", callback_data="admin_back")]
+                    ]),
+                    parse_mode="HTML"
+                )
+            except Exception as e:
+                logging.error(f"Mailing #{job_id} report failed: {e}")
+
+    async def _report_stopped(self, bot: Bot, job, status: str, success: int, failed: int):
+        """
+        Показывает в сообщении прогресса, что задание действительно остановилось.
+        """
+        if status == 'cancelled':
+            text = mailing_cancelled_text(job.id, job.total, success, failed)
+            markup = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 В админ-панель", callback_data="admin_back")]
+            ])
+        else:
+            text = mailing_progress_text(job.id, job.total, success + failed, success, failed, paused=True)
+            markup = mailing_job_kb(job.id, status)
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=job.progress_chat_id,
+                message_id=job.progress_message_id,
+                reply_markup=markup
+            )
+        except Exception as e:
+            logging.debug(f"Mailing #{job.id} stop report failed: {e}")
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import random
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+
+
+class PrefetchPool:
+    """
+    Пул заранее загруженных элементов по ключам (например, фильмов по жанрам).
+
+    pop() отдает готовый элемент сразу, а когда в пуле остается меньше
+    low_water элементов, в фоне запускается пополнение через fetch(key).
+    Если задан id_of, элементы с уже лежащим в пуле id при пополнении пропускаются.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[Hashable], Awaitable[List[Any]]],
+        keys: Iterable[Hashable],
+        low_water: int = 3,
+        max_size: int = 30,
+        id_of: Optional[Callable[[Any], Hashable]] = None,
+    ):
+        self._fetch = fetch
+        self._id_of = id_of
+        self.low_water = low_water
+        self.max_size = max_size
+        self._pools: Dict[Hashable, deque] = {key: deque() for key in keys}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._pools
+
+    def _schedule(self, key: Hashable) -> asyncio.Task:
+        """
+        Запускает пополнение пула, если оно еще не идет.
+        """
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            task = asyncio.create_task(self._refill(key))
+            self._tasks[key] = task
+        return task
+
+    async def _refill(self, key: Hashable):
+        try:
+            items = await self._fetch(key)
+        except Exception as e:
+            logging.error(f"Prefetch for {key!r} failed: {e}")
+            return
+        items = list(items)
+        random.shuffle(items)
+        pool = self._pools[key]
+        if self._id_of is not None:
+            seen = {self._id_of(item) for item in pool}
+            fresh = []
+            for item in items:
+                item_id = self._id_of(item)
+                if item_id not in seen:
+                    seen.add(item_id)
+                    fresh.append(item)
+            items = fresh
+        pool.extend(items)
+        while len(pool) > self.max_size:
+            pool.popleft()
+        logging.debug(f"Prefetch pool {key!r}: {len(pool)} items")
+
+    async def pop(self, key: Hashable) -> Optional[Any]:
+        """
+        Возвращает элемент из пула. Если пул пуст, дожидается пополнения.
+        """
+        pool = self._pools[key]
+        if not pool:
+            await asyncio.shield(self._schedule(key))
+        item = pool.popleft() if pool else None
+        if len(pool) < self.low_water:
+            self._schedule(key)
+        return item
+
+    async def warm_up(self):
+        """
+        Запускает фоновое заполнение всех пулов.
+        """
+        for key in self._pools:
+            self._schedule(key)
+
+    async def close(self):
+        """
+        Отменяет незавершенные пополнения.
+        """
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def sizes(self) -> Dict[Hashable, int]:
+        return {key: len(pool) for key, pool in self._pools.items()}
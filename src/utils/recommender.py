@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from src.database.crud import CRUDRecommendation
+from src.database.engine import async_session_maker, engine
+
+
+def compute_recommendations(
+    interactions: Sequence[Tuple[int, int, float]],
+    top_k: int = 10,
+) -> List[Dict[str, float]]:
+    """
+    Item-item рекомендации по совместной встречаемости.
+
+    Строит разреженную матрицу пользователь x фильм, считает косинусную близость
+    фильмов C = X^T X / (|x_i| |x_j|) и оценки S = X C. Для каждого пользователя
+    возвращает top_k фильмов, с которыми он еще не взаимодействовал.
+    """
+    if not interactions:
+        return []
+    data = np.asarray(interactions, dtype=np.float64)
+    user_ids, user_idx = np.unique(data[:, 0].astype(np.int64), return_inverse=True)
+    movie_ids, movie_idx = np.unique(data[:, 1].astype(np.int64), return_inverse=True)
+
+    # Повторные взаимодействия суммируются (duplicates в COO складываются)
+    X = sparse.coo_matrix(
+        (data[:, 2], (user_idx, movie_idx)),
+        shape=(len(user_ids), len(movie_ids)),
+    ).tocsr()
+
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0)).ravel())
+    norms[norms == 0] = 1.0
+    inv_norms = sparse.diags(1.0 / norms)
+
+    C = (inv_norms @ (X.T @ X) @ inv_norms).tolil()
+    C.setdiag(0)
+    S = (X @ C.tocsr()).tocsr()
+
+    # Уже просмотренное не рекомендуем
+    seen = X.copy()
+    seen.data[:] = 1
+    S = (S - S.multiply(seen)).tocsr()
+    S.eliminate_zeros()
+
+    rows = []
+    for u in range(S.shape[0]):
+        start, end = S.indptr[u], S.indptr[u + 1]
+        if start == end:
+            continue
+        scores = S.data[start:end]
+        columns = S.indices[start:end]
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        for i in best[np.argsort(-scores[best])]:
+            rows.append({
+                'user_id': int(user_ids[u]),
+                'movie_id': int(movie_ids[columns[i]]),
+                'score': float(scores[i]),
+            })
+    return rows
+
+
+async def rebuild_recommendations(top_k: int = 10) -> int:
+    """
+    Пересчитывает таблицу recommendations целиком. Возвращает число записей.
+    """
+    crud = CRUDRecommendation()
+    async with async_session_maker() as session:
+        interactions = [tuple(row) for row in await crud.get_interactions(session)]
+    rows = compute_recommendations(interactions, top_k=top_k)
+    async with async_session_maker() as session:
+        await crud.replace_all(session, rows)
+    return len(rows)
+
+
+async def main():
+    try:
+        count = await rebuild_recommendations(top_k=int(getenv("RECOMMENDATIONS_TOP_K", "10")))
+        logging.info(f"Рекомендации пересчитаны: {count}")
+    finally:
+        await engine.dispose()
+
+
+# Запуск по расписанию (cron): python -m src.utils.recommender
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())